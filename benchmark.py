@@ -0,0 +1,277 @@
+'''
+Benchmarks for the COVID-19 dashboard's data-shaping functions and busiest
+routes.
+
+Everything runs offline against replayed upstream responses (see
+UPSTREAM_MODE in final_project_app.py), in a scratch directory so the
+caches and database next to the app are left alone. By default a small,
+repeatable set of recordings is generated for the benchmarked states; pass
+--replay-dir to use responses saved with UPSTREAM_MODE=record instead.
+
+Startup is timed first: importing the app and calling create_app() in a
+fresh interpreter, which should take milliseconds and leave no files behind.
+
+Each case is timed with cold caches (every cache store and in-process memo
+emptied before each call) and warm caches. Latency is reported as p50/p99
+and memory as the tracemalloc peak and the number of blocks still allocated
+after one call.
+
+Usage:
+    python benchmark.py                        # print the results
+    python benchmark.py --save baseline.json   # ... and keep them as a baseline
+    python benchmark.py --compare baseline.json [--tolerance 0.25]
+
+With --compare the exit status is 1 when any case's p50, p99 or peak memory
+is more than tolerance above the baseline.
+'''
+import argparse
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CSV_FILES = ['at_risk_pop.csv', 'state_obesity_stats.csv', 'icu_beds.csv',
+    'hosp_beds.csv', 'info.csv']
+BENCH_STATES = ['MI', 'OH', 'NY']
+HISTORY_DAYS = 365
+ARTICLE_COUNT = 40
+STARTUP_RUNS = 10
+# run in a fresh interpreter; prints the seconds taken and the peak RSS in KiB
+STARTUP_CODE = '''
+import resource, time
+started = time.perf_counter()
+import final_project_app
+final_project_app.create_app()
+print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def daily_rows(state, days=HISTORY_DAYS):
+    '''a made-up but realistically shaped daily history, newest first'''
+    first = datetime.date(2020, 3, 1)
+    rows = []
+    for i in range(days):
+        date = first + datetime.timedelta(days=i)
+        rows.append({
+            'state': state,
+            'date': int(date.strftime('%Y%m%d')),
+            'positive': 40 * i * i,
+            'hospitalizedCurrently': None if i % 9 == 0 else 50 + 3 * i,
+            'recovered': None if i < 14 else 20 * i * i,
+            'death': 2 * i,
+        })
+    rows.reverse()
+    return rows
+
+
+def write_recordings(fpa, directory):
+    '''saves the responses the benchmarks request into directory'''
+    def save(url, params, body, content_type='application/json'):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        fpa.save_recording(url, params, 200,
+            {'ETag': f'"{len(body)}"', 'Content-Type': content_type},
+            body, directory)
+
+    with open(os.path.join(HERE, 'info.csv'), encoding='utf-8', errors='replace') as f:
+        states = [
+            {
+                'state': r['state'],
+                'name': r['name'],
+                'fips': r['fips'],
+                'covid19Site': r['covid19Site'],
+                'covid19SiteSecondary': r['covid19SiteSecondary'],
+                'twitter': f"@{r['state']}health",
+            }
+            for r in csv.DictReader(f)]
+    save(fpa.COVID_BASE_URL + 'info', {'state': None}, states)
+    for state in BENCH_STATES:
+        save(fpa.COVID_BASE_URL + 'daily', {'state': state}, daily_rows(state))
+    for account in ['from:@CDCgov'] + [f'from:@{s}health' for s in BENCH_STATES]:
+        save(fpa.TWITTER_BASEURL, {'q': account, 'count': fpa.TIMELINE_SIZE}, {'statuses': [
+            {'id': 1000 + i, 'created_at': 'Mon Apr 20 12:00:00 +0000 2020',
+                'text': f'{account} update {i}'}
+            for i in reversed(range(fpa.TIMELINE_SIZE))]})
+    save(fpa.NEWS_API_BASE_URL, {'country': 'us', 'q': 'COVID-19'}, {'articles': [
+        {'title': f'Headline {i}', 'author': 'Staff', 'url': f'https://example.com/{i}'}
+        for i in range(ARTICLE_COUNT)]})
+    with open(os.path.join(HERE, 'fixtures', 'kff', 'at_risk_pop.html'), encoding='utf-8') as f:
+        save(fpa.AT_RISK_POP_URL, None, f.read(), 'text/html')
+
+
+def build_cases(fpa):
+    '''returns [(name, function)] for everything that is benchmarked'''
+    client = fpa.create_app().test_client()
+
+    def route(method, path, **kwargs):
+        def call():
+            response = client.open(path, method=method, follow_redirects=True, **kwargs)
+            response.get_data()
+            if response.status_code != 200:
+                raise RuntimeError(f'{method} {path} answered {response.status_code}')
+        return call
+
+    state = BENCH_STATES[0]
+    return [
+        ('get_covid_state_data', lambda: fpa.get_covid_state_data(state)),
+        ('plotly_lists', lambda: fpa.plotly_lists(state)),
+        ('extract_at_risk_pop', fpa.extract_at_risk_pop),
+        ('get_state_profile', lambda: fpa.get_state_profile(state)),
+        ('POST /handle_form', route('POST', '/handle_form', data={
+            'states': state, 'health_status': 'on', 'cdc_tweets': 'on',
+            'state_hd_tweets': 'on'})),
+        (f'GET /state/{state}', route('GET', f'/state/{state}?health=1&cdc=1&hd=1')),
+        (f'GET /covid_plot/{state}', route('GET', f'/covid_plot/{state}')),
+        ('GET /covid_plot 90d/100pt', route('GET', f'/covid_plot/{state}?days=90&points=100')),
+        ('GET /articles', route('GET', '/articles')),
+    ]
+
+
+def measure(fpa, fn, cold, iterations):
+    '''times iterations calls of fn, then traces the memory of one more'''
+    quiet = io.StringIO()
+    timings = []
+    with contextlib.redirect_stdout(quiet):
+        if not cold:
+            fn()
+        for _ in range(iterations):
+            if cold:
+                fpa.reset_caches()
+            started = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - started)
+            quiet.seek(0)
+            quiet.truncate()
+
+        if cold:
+            fpa.reset_caches()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        fn()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    timings = np.array(timings) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p99_ms': round(float(np.percentile(timings, 99)), 3),
+        'peak_kib': round(peak / 1024, 1),
+        'blocks': int(blocks),
+    }
+
+
+def measure_startup(runs):
+    '''times importing the app and building it in runs fresh interpreters,
+    in the current directory'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [HERE, os.environ.get('PYTHONPATH')])))
+    timings, peaks = [], []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', STARTUP_CODE], env=env,
+            check=True, capture_output=True, text=True).stdout.split()
+        timings.append(float(out[-2]))
+        peaks.append(int(out[-1]))
+    timings = np.array(timings) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p99_ms': round(float(np.percentile(timings, 99)), 3),
+        'peak_kib': float(max(peaks)),
+        'blocks': None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''returns a line for every measurement that regressed past tolerance'''
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for field in ('p50_ms', 'p99_ms', 'peak_kib'):
+            if base[field] and result[field] > base[field] * (1 + tolerance):
+                regressions.append(f'{name}: {field} {base[field]} -> {result[field]}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--iterations', type=int, default=50,
+        help='timed calls per case and cache state (default 50)')
+    parser.add_argument('--replay-dir',
+        help='recorded upstream responses to use instead of generated ones')
+    parser.add_argument('--save', metavar='FILE', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='baseline to check the results against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='allowed slowdown/growth over the baseline (default 0.25)')
+    args = parser.parse_args(argv)
+
+    save_path = os.path.abspath(args.save) if args.save else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix='covid-bench-')
+    replay_dir = os.path.abspath(args.replay_dir) if args.replay_dir else os.path.join(workdir, 'upstream')
+    for name in CSV_FILES:
+        shutil.copy(os.path.join(HERE, name), workdir)
+    os.environ['UPSTREAM_MODE'] = 'replay'
+    os.environ['REPLAY_DIR'] = replay_dir
+    os.environ.setdefault('REPLAY_LATENCY', '0')
+    os.environ.setdefault('REPLAY_ERROR_RATE', '0')
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    try:
+        print(f'{"case":<28}{"caches":<8}{"p50 ms":>10}{"p99 ms":>10}{"peak KiB":>11}{"blocks":>9}')
+        before = set(os.listdir(workdir))
+        result = measure_startup(STARTUP_RUNS)
+        results = {'import + create_app [cold]': result}
+        print(f'{"import + create_app":<28}{"cold":<8}{result["p50_ms"]:>10}{result["p99_ms"]:>10}'
+            f'{result["peak_kib"]:>11}{"-":>9}')
+        created = sorted(set(os.listdir(workdir)) - before)
+        if created:
+            print(f'WARNING startup created {", ".join(created)}')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            import final_project_app as fpa
+            if not args.replay_dir:
+                write_recordings(fpa, replay_dir)
+            fpa.ingest()
+
+        for name, fn in build_cases(fpa):
+            for cold in (True, False):
+                label = 'cold' if cold else 'warm'
+                result = measure(fpa, fn, cold, args.iterations)
+                results[f'{name} [{label}]'] = result
+                print(f'{name:<28}{label:<8}{result["p50_ms"]:>10}{result["p99_ms"]:>10}'
+                    f'{result["peak_kib"]:>11}{result["blocks"]:>9}')
+    finally:
+        os.chdir(HERE)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.save}')
+    if compare_path:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.compare}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,44 @@
-from bs4 import BeautifulSoup
-from requests_oauthlib import OAuth1
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import gzip
+import hashlib
+import hmac
+import itertools
 import json
+import os
+import random
+import sys
 import time
+import threading
 import sqlite3
+import contextlib
+import contextvars
 import csv
-import secrets
-from collections import defaultdict
+import functools
+import importlib.metadata
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from collections import OrderedDict, defaultdict, namedtuple
 from datetime import datetime
-from datetime import date
-from flask import Flask, render_template, request
-import plotly.graph_objects as go
-app = Flask(__name__)
+from io import BytesIO
+from urllib.parse import urlparse
+import click
+from flask import (Blueprint, Flask, Response, abort, current_app, g, jsonify,
+    redirect, render_template, request, stream_with_context, url_for)
+import numpy as np
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# Plotly, BeautifulSoup and requests_oauthlib are slow to import, so they are
+# imported by the functions that use them rather than here; importing this
+# module (and create_app) does no I/O
+bp = Blueprint('dashboard', __name__, cli_group=None)
 
 '''
 CITATIONS/ACKNOWLEDGMENTS:
@@ -25,38 +52,57 @@ examples and assignments.
 
 '''
 
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
 COVID_BASE_URL = 'https://covidtracking.com/api/states/'
-CACHE_FILE_NAME = 'cov_cache.json'
-COVID_CACHE = {}
+COVID_ALL_STATES_URL = 'https://covidtracking.com/api/v1/states/daily.json'
+CACHE_FILE_NAME = 'cov_cache.sqlite'
+COVID_CACHE_TTL = 6 * HOUR
+COVID_CACHE_MAX_ENTRIES = 200
 
 STATE_COV_INFO_URL = 'https://covidtracking.com/api/states/info'
-STATE_CACHE_NAME = 'state_cov_info_cache.json'
-STATE_COV_CACHE = {}
+STATE_CACHE_NAME = 'state_cov_info_cache.sqlite'
+STATE_CACHE_TTL = WEEK
+STATE_CACHE_MAX_ENTRIES = 10
 
 STATE_DATA_URL = 'https://www.kff.org/statedata/'
 HEALTH_STATUS_URL = 'https://www.kff.org/state-category/health-status/'
 COVID_RISK_URL = 'https://www.kff.org/other/state-indicator/adults-at-higher-risk-of-serious-illness-if-infected-with-coronavirus/'
+KFF_CACHE_NAME = 'kff_cache.sqlite'
+KFF_CACHE_TTL = 4 * WEEK
+KFF_CACHE_MAX_ENTRIES = 100
 
 TWITTER_BASEURL = "https://api.twitter.com/1.1/search/tweets.json"
-TWITTER_CACHE_FILENAME = "twitter_cache.json"
-TWITTER_CACHE_DICT = {}
+TWITTER_CACHE_FILENAME = "twitter_cache.sqlite"
+TWITTER_CACHE_TTL = 15 * MINUTE
+TWITTER_CACHE_MAX_ENTRIES = 500
 
 NEWS_API_BASE_URL = 'https://newsapi.org/v2/top-headlines'
-NEWS_CACHE_FILENAME = "news_cache.json"
-NEWS_CACHE_DICT = {}
+NEWS_CACHE_FILENAME = "news_cache.sqlite"
+NEWS_CACHE_TTL = 30 * MINUTE
+NEWS_CACHE_MAX_ENTRIES = 20
+
 
-FIPS_CACHE_NAME = "fips_cache.json"
-FIPS_CACHE = {}
+def get_secret(name):
+    '''reads an API credential from secrets.py, falling back to the
+    environment variable of the same name (or '' when neither is set, e.g.
+    when running in replay mode without credentials)'''
+    import secrets
+    return getattr(secrets, name, None) or os.environ.get(name, '')
 
-client_key = secrets.TWITTER_API_KEY
-client_secret = secrets.TWITTER_API_SECRET
-access_token = secrets.TWITTER_ACCESS_TOKEN
-access_token_secret = secrets.TWITTER_ACCESS_TOKEN_SECRET
 
-oauth = OAuth1(client_key,
-            client_secret=client_secret,
-            resource_owner_key=access_token,
-            resource_owner_secret=access_token_secret)
+@functools.lru_cache(maxsize=None)
+def get_oauth():
+    '''the Twitter OAuth1 credentials, built the first time Tweets are
+    requested'''
+    from requests_oauthlib import OAuth1
+    return OAuth1(get_secret('TWITTER_API_KEY'),
+            client_secret=get_secret('TWITTER_API_SECRET'),
+            resource_owner_key=get_secret('TWITTER_ACCESS_TOKEN'),
+            resource_owner_secret=get_secret('TWITTER_ACCESS_TOKEN_SECRET'))
 
 headers = {
     'User-Agent': 'UMSI 507 Course Project - Python Scraping',
@@ -65,61 +111,1157 @@ headers = {
 }
 
 
-def load_cache(cache_file):
-    '''opens cache if it exists and loads JSON into
-    respective cache_dict
+class TokenBucket:
+    '''A thread-safe token bucket that allows `rate` requests per second
+    on average with bursts of up to `capacity` requests.
 
-    if the cache file doesn't exist, it creates a new cache dictionary
+    A caller only sleeps when the bucket is empty, and it reserves its token
+    before sleeping so that callers waiting at the same time queue up behind
+    each other instead of all waking at once.
+    '''
 
-    Parameters:
-    None
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.requests = 0
+        self.waits = 0
+        self.seconds_waited = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''takes one token, sleeping until one is available
+
+        Returns
+        -------
+        float
+            the number of seconds spent waiting
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            self.requests += 1
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+                self.waits += 1
+                self.seconds_waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'waits': self.waits,
+            'seconds_waited': round(self.seconds_waited, 3),
+        }
+
+
+# (requests per second, burst size) for each upstream host
+RATE_LIMITS = {
+    'covidtracking.com': (2, 10),
+    'www.kff.org': (1, 3),
+    'api.twitter.com': (180 / (15 * MINUTE), 10),
+    'newsapi.org': (1, 5),
+}
+RATE_LIMITERS = {host: TokenBucket(rate, capacity)
+                 for host, (rate, capacity) in RATE_LIMITS.items()}
 
-    Returns:
-    Cache
+
+def wait_for_rate_limit(url):
+    '''blocks until the host of url has budget for another request
+
+    Hosts without a configured limit are never delayed.
+
+    Parameters
+    ----------
+    url: string
+        the URL about to be requested
+
+    Returns
+    -------
+    float
+        the number of seconds spent waiting
+    '''
+    limiter = RATE_LIMITERS.get(urlparse(url).netloc)
+    if limiter is None:
+        return 0.0
+    waited = limiter.acquire()
+    if waited > 0:
+        print(f"Rate limited: waited {waited:.2f}s for {urlparse(url).netloc}")
+    return waited
+
+
+def rate_limit_stats():
+    '''returns the request and wait counters for each upstream host'''
+    return {host: limiter.stats() for host, limiter in RATE_LIMITERS.items()}
+
+
+# (connect, read) timeouts in seconds for every upstream request
+REQUEST_TIMEOUT = (3.05, 15)
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+SESSION_POOL_SIZE = 10
+
+# 'live' talks to the real upstreams, 'replay' answers every request from
+# the recordings in REPLAY_DIR, and 'record' talks to the upstreams and saves
+# what they return there
+UPSTREAM_MODE = os.environ.get('UPSTREAM_MODE', 'live')
+REPLAY_DIR = os.environ.get('REPLAY_DIR', os.path.join('fixtures', 'upstream'))
+# seconds added to every replayed request, and the fraction of replayed
+# requests answered with a 503 instead of the recording
+REPLAY_LATENCY = float(os.environ.get('REPLAY_LATENCY', 0))
+REPLAY_ERROR_RATE = float(os.environ.get('REPLAY_ERROR_RATE', 0))
+# query parameters that hold credentials, left out of recording keys
+SECRET_PARAMS = ('apiKey',)
+# query parameters that only ask for what is new since an earlier response
+# (see TimelineUpdate): also left out of recording keys, so the full
+# recording answers them, and responses to them are not recorded
+INCREMENTAL_PARAMS = ('since_id',)
+
+SESSIONS = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    '''returns the shared requests.Session for the host of url
+
+    Sessions keep a pool of keep-alive connections to their host and retry
+    failed GETs with exponential backoff, honouring Retry-After.
+
+    Parameters
+    ----------
+    url: string
+        the URL about to be requested
+
+    Returns
+    -------
+    requests.Session
+    '''
+    host = urlparse(url).netloc
+    with _sessions_lock:
+        session = SESSIONS.get(host)
+        if session is None:
+            retry = Retry(
+                total=RETRY_TOTAL,
+                backoff_factor=RETRY_BACKOFF_FACTOR,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=['GET'],
+                respect_retry_after_header=True,
+                raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1,
+                pool_maxsize=SESSION_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update(headers)
+            SESSIONS[host] = session
+    return session
+
+
+def fetch(url, params=None, auth=None, entry=None, stream=False):
+    '''makes a rate-limited GET through the pooled session for url's host
+
+    Parameters
+    ----------
+    url: string
+        the URL to request
+    params: dict
+        query string parameters
+    auth: requests auth object
+        e.g. the Twitter OAuth1 credentials
+    entry: CacheEntry
+        a cached copy of this resource; its ETag/Last-Modified are sent so
+        the upstream can answer 304 Not Modified instead of a full body
+    stream: bool
+        don't read the body up front, so it can be parsed incrementally
+
+    Returns
+    -------
+    requests.Response
     '''
+    request_headers = {}
+    if entry is not None:
+        if entry.etag:
+            request_headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            request_headers['If-Modified-Since'] = entry.last_modified
+    with span('upstream', urlparse(url).netloc):
+        if UPSTREAM_MODE == 'replay':
+            return replay(url, params, request_headers)
+        wait_for_rate_limit(url)
+        response = get_session(url).get(url, params=params, auth=auth,
+            headers=request_headers, timeout=REQUEST_TIMEOUT, stream=stream)
+    if (UPSTREAM_MODE == 'record' and response.status_code == 200
+            and not any(name in (params or {}) for name in INCREMENTAL_PARAMS)):
+        save_recording(url, params, response.status_code, response.headers,
+            response.content)
+        return replayed_response(url, load_recording(url, params))
+    return response
+
+
+def recording_path(url, params=None, directory=None):
+    '''returns the file a recording of url+params is kept in
+
+    Files are named by a hash of the construct_unique_key key (with
+    credentials and incremental parameters left out), since the key itself
+    is not a safe file name.
+    '''
+    params = {k: v for k, v in (params or {}).items()
+        if k not in SECRET_PARAMS and k not in INCREMENTAL_PARAMS}
+    key = construct_unique_key(url, params)
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+    return os.path.join(directory or REPLAY_DIR, name)
+
+
+def save_recording(url, params, status, response_headers, body, directory=None):
+    '''writes a response for url+params to the replay directory
+
+    Parameters
+    ----------
+    url: string
+        the URL that was requested
+    params: dict
+        its query string parameters, or None
+    status: int
+        the HTTP status code
+    response_headers: mapping
+        only ETag, Last-Modified and Content-Type are kept
+    body: bytes or string
+        the response body
+    directory: string
+        where to write it, REPLAY_DIR by default
+    '''
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    path = recording_path(url, params, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    recording = {
+        'url': url,
+        'params': {k: v for k, v in (params or {}).items() if k not in SECRET_PARAMS},
+        'status': status,
+        'headers': {name: response_headers[name]
+            for name in ('ETag', 'Last-Modified', 'Content-Type')
+            if response_headers.get(name)},
+        'body': body,
+    }
+    with open(path, 'w', encoding='utf-8') as file_obj:
+        json.dump(recording, file_obj)
+
+
+def load_recording(url, params=None):
     try:
-        cache_file = open(cache_file, 'r')
-        cache_file_contents = cache_file.read()
-        cache_dict = json.loads(cache_file_contents)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
+        with open(recording_path(url, params), encoding='utf-8') as file_obj:
+            return json.load(file_obj)
+    except FileNotFoundError:
+        return None
+
+
+def replayed_response(url, recording, status=None):
+    '''builds a requests.Response carrying a recording's status, headers
+    and body, readable through .text/.json() or streamed through .raw'''
+    response = requests.Response()
+    response.url = url
+    response.status_code = status or recording['status']
+    response.headers.update(recording['headers'])
+    response.encoding = 'utf-8'
+    response._content = b'' if status else recording['body'].encode('utf-8')
+    response.raw = BytesIO(response._content)
+    return response
+
+
+def replay(url, params, request_headers):
+    '''answers a request from its recording in REPLAY_DIR, after
+    REPLAY_LATENCY seconds and failing REPLAY_ERROR_RATE of the time
+
+    A request that was never recorded fails as if the upstream could not
+    be reached.
+    '''
+    if REPLAY_LATENCY:
+        time.sleep(REPLAY_LATENCY)
+    recording = load_recording(url, params)
+    if recording is None:
+        raise requests.ConnectionError(
+            f'no recording for {url} in {REPLAY_DIR}')
+    if REPLAY_ERROR_RATE and random.random() < REPLAY_ERROR_RATE:
+        response = replayed_response(url, recording, status=503)
+        response.reason = 'Service Unavailable (injected)'
+        return response
+    etag = recording['headers'].get('ETag')
+    if etag and request_headers.get('If-None-Match') == etag:
+        return replayed_response(url, recording, status=304)
+    return replayed_response(url, recording)
+
+
+_stale_sources = contextvars.ContextVar('stale_sources', default=None)
+
 
+def track_staleness():
+    '''starts collecting, for the current request, the names of sources
+    that were answered from a stale cache entry
 
-COVID_CACHE = load_cache('cov_cache.json')
-URL_CACHE = load_cache('state_cov_info_cache.json')
+    Returns
+    -------
+    set
+        filled in by note_stale as the request runs
+    '''
+    stale = set()
+    _stale_sources.set(stale)
+    return stale
+
+
+def note_stale(source):
+    stale = _stale_sources.get()
+    if stale is not None:
+        stale.add(source)
+
+
+_trace = contextvars.ContextVar('trace', default=None)
+
+# upper bounds, in seconds, of the histogram buckets timings are counted in
+TIMING_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
 
+class Histogram:
+    '''A thread-safe Prometheus-style histogram.
+
+    For each combination of label values it keeps how many observations
+    fell at or under each bucket bound, and their count and sum, and
+    renders them in the Prometheus text format.
+    '''
+
+    def __init__(self, name, help_text, label_names, buckets=TIMING_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        '''returns the histogram as lines of the Prometheus text format'''
+        lines = [f'# HELP {self.name} {self.help_text}',
+            f'# TYPE {self.name} histogram']
+        with self._lock:
+            all_series = sorted((labels, list(series))
+                for labels, series in self._series.items())
+        for label_values, series in all_series:
+            labels = ','.join(f'{name}="{prometheus_escape(value)}"'
+                for name, value in zip(self.label_names, label_values))
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{labels}}} {series[-2]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-1]:.6f}')
+        return lines
+
+
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('covid_request_seconds',
+    'Time spent handling requests, by route', ['route'])
+SPAN_SECONDS = Histogram('covid_span_seconds',
+    'Time spent in upstream calls, cache lookups, SQLite queries and rendering',
+    ['kind', 'detail'])
+
+
+def start_trace():
+    '''starts collecting timing spans for the current request
+
+    Returns
+    -------
+    list
+        filled in with (kind, detail, seconds) as the request runs,
+        including by work it hands to UPSTREAM_POOL
+    '''
+    trace = []
+    _trace.set(trace)
+    return trace
 
-def save_cache(cache_dict):
-    ''' saves the information in cache
+
+@contextlib.contextmanager
+def span(kind, detail=''):
+    '''times the block, counting it in SPAN_SECONDS and adding it to the
+    current request's trace (if there is one)
+
+    Parameters
+    ----------
+    kind: string
+        upstream, cache, db, plot or template
+    detail: string
+        which one: the upstream host, cache name, query or template
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        SPAN_SECONDS.observe(elapsed, kind, detail)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((kind, detail, elapsed))
+
+
+# cache name -> {request key: (url, params, auth, extract)} for everything requested
+# since startup, so the scheduler knows what to keep warm
+WATCHED = defaultdict(dict)
+
+
+def revalidate(url, params, cache, request_key, auth=None, extract=None):
+    '''fetches url into cache, using a conditional GET if there is
+    already a copy
+
+    Returns
+    -------
+    string
+        the (possibly unchanged) response body, or what extract made of it
+    '''
+    entry = cache.get_entry(request_key)
+    if isinstance(extract, TimelineUpdate):
+        # only ask for what is newer than the stored copy, and merge it in
+        previous = entry.value if entry is not None else None
+        response = fetch(url, params=extract.params(params, previous), auth=auth)
+        response.raise_for_status()
+        value = extract.merge(previous, response.text)
+        cache.set(request_key, value, version=str(value['since_id'] or 0))
+        return value
+    response = fetch(url, params=params, auth=auth, entry=entry)
+    if response.status_code == 304 and entry is not None:
+        cache.touch(request_key)
+        return entry.value
+    response.raise_for_status()
+    value = response.text if extract is None else extract(response.text)
+    cache.set(request_key, value,
+        etag=response.headers.get('ETag'),
+        last_modified=response.headers.get('Last-Modified'))
+    return value
+
+
+def fetch_using_cache(url, params, cache, request_key, auth=None, extract=None):
+    '''returns the body for url from cache, refetching it when it is stale
+
+    While the background scheduler is running, a stale entry is returned
+    straight away and revalidated in the background (stale-while-
+    revalidate); otherwise it is revalidated with a conditional GET before
+    returning. If the upstream cannot be reached or errors, a stale copy is
+    returned rather than failing the page. Either way the source is noted
+    as stale for the current request.
+
+    Concurrent misses for the same key are coalesced: one thread fetches
+    while the others wait for its result.
+
+    Parameters
+    ----------
+    url: string
+        the URL to request
+    params: dict
+        query string parameters, or None
+    cache: CacheStore
+        the cache for this source
+    request_key: string
+        the key the body is stored under
+    auth: requests auth object
+        e.g. the Twitter OAuth1 credentials
+    extract: function
+        turns the response body into what is stored in the cache, so
+        pages that are scraped keep only the extracted data
+
+    Returns
+    -------
+    string
+        the response body, or what extract made of it
+    '''
+    WATCHED[cache.name][request_key] = (url, params, auth, extract)
+    with span('cache', cache.name):
+        entry = cache.get_entry(request_key)
+    if entry is not None and entry.fresh:
+        print("Using cache")
+        cache.record('hits')
+        return entry.value
+    if entry is not None and SCHEDULER.running:
+        print("Using stale cache, refreshing in the background")
+        cache.record('stale_hits')
+        note_stale(cache.name)
+        SCHEDULER.request_refresh(f'{cache.name}:{request_key}',
+            cache.flight.do, request_key, revalidate,
+            url, params, cache, request_key, auth, extract)
+        return entry.value
+    return cache.flight.do(request_key, _fetch_missing,
+        url, params, cache, request_key, auth, extract)
+
+
+def _fetch_missing(url, params, cache, request_key, auth, extract):
+    '''the part of fetch_using_cache that only one thread per key runs'''
+    entry = cache.get_entry(request_key)
+    if entry is not None and entry.fresh:
+        # another request filled it while this one was waiting for the lock
+        return entry.value
+    if not cache.acquire_lease(request_key):
+        # another process is fetching it: wait for its result
+        cache.record('lease_waits')
+        filled = wait_for_other_process(cache, request_key, entry)
+        if filled is not None:
+            return filled.value
+    print("Fetching")
+    cache.record('misses')
+    try:
+        return revalidate(url, params, cache, request_key, auth, extract)
+    except requests.RequestException:
+        if entry is None:
+            raise
+        print("Upstream failed, using stale cache")
+        note_stale(cache.name)
+        return entry.value
+    finally:
+        cache.release_lease(request_key)
+
+
+LEASE_POLL_INTERVAL = 0.05
+
+
+def wait_for_other_process(cache, request_key, entry):
+    '''waits while another process holds the lease on request_key
+
+    Returns
+    -------
+    CacheEntry
+        the fresh entry the other process stored, or None if its lease
+        ended without one (it failed, or died) and this process should
+        fetch after all
+    '''
+    while True:
+        expires = cache.lease_expires(request_key)
+        latest = cache.peek(request_key)
+        if latest is not None and latest.fresh and (
+                entry is None or latest.stored_at != entry.stored_at):
+            return cache.get_entry(request_key)
+        if expires is None or expires < time.time():
+            return None
+        time.sleep(LEASE_POLL_INTERVAL)
+
+
+class SingleFlight:
+    '''Collapses concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; callers that arrive
+    while it is still running wait for and share its result (or its
+    exception) instead of making the same upstream request again.
+    '''
+
+    def __init__(self):
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+class RefreshScheduler:
+    '''Keeps upstream data warm from a background thread.
+
+    Each job refreshes one source on its own interval. Requests that find
+    a stale cache entry can also ask for that one entry to be refreshed;
+    those refreshes are de-duplicated by key so a popular stale entry is
+    only fetched once. Jobs and refreshes run on a small worker pool so a
+    slow source does not hold up the others.
+    '''
+
+    def __init__(self, workers=2):
+        self.jobs = {}
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._workers = workers
+        self._pool = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def add_job(self, name, interval, fn):
+        '''runs fn every interval seconds, starting as soon as the
+        scheduler starts
+        '''
+        with self._lock:
+            self.jobs[name] = {
+                'interval': interval,
+                'fn': fn,
+                'next_run': time.time(),
+                'last_run': None,
+                'last_success': None,
+                'last_error': None,
+                'running': False,
+                'runs': 0,
+            }
+        self._wakeup.set()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._pool = ThreadPoolExecutor(max_workers=self._workers,
+            thread_name_prefix='refresh')
+        self._thread = threading.Thread(target=self._loop,
+            name='refresh-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def request_refresh(self, key, fn, *args):
+        '''refreshes one entry in the background unless a refresh for key
+        is already under way
+        '''
+        with self._lock:
+            if key in self._pending or self._pool is None:
+                return
+            future = self._pool.submit(fn, *args)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._refresh_done(key, f))
+
+    def _refresh_done(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            self.refreshes += 1
+            if future.exception() is not None:
+                self.refresh_failures += 1
+                print(f"Background refresh of {key} failed: {future.exception()!r}")
+
+    def _run_job(self, name, job):
+        job['last_run'] = time.time()
+        try:
+            job['fn']()
+            job['last_success'] = time.time()
+            job['last_error'] = None
+        except Exception as e:
+            job['last_error'] = repr(e)
+            print(f"Refresh job {name} failed: {e!r}")
+        finally:
+            with self._lock:
+                job['runs'] += 1
+                job['running'] = False
+                job['next_run'] = time.time() + job['interval']
+            self._wakeup.set()
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            now = time.time()
+            with self._lock:
+                for name, job in self.jobs.items():
+                    if not job['running'] and job['next_run'] <= now:
+                        job['running'] = True
+                        self._pool.submit(self._run_job, name, job)
+                waiting = [job['next_run'] for job in self.jobs.values()
+                           if not job['running']]
+            timeout = max(0.0, min(waiting) - now) if waiting else None
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def status(self):
+        '''returns the state of every job and of on-demand refreshes'''
+        def when(timestamp):
+            if timestamp is None:
+                return None
+            return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+
+        with self._lock:
+            jobs = {
+                name: {
+                    'interval_seconds': job['interval'],
+                    'running': job['running'],
+                    'runs': job['runs'],
+                    'last_run': when(job['last_run']),
+                    'last_success': when(job['last_success']),
+                    'last_error': job['last_error'],
+                    'next_run': when(job['next_run']),
+                }
+                for name, job in self.jobs.items()
+            }
+            return {
+                'running': self.running,
+                'jobs': jobs,
+                'refreshes_pending': len(self._pending),
+                'refreshes_done': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+            }
+
+
+SCHEDULER = RefreshScheduler()
+
+
+# request key -> (STORED_AT of the body, parsed JSON), most recently used last
+_PARSED_JSON = OrderedDict()
+_PARSED_JSON_LOCK = threading.Lock()
+
+
+def parse_json_once(cache, request_key, text):
+    '''json.loads text, the body cached under request_key in cache,
+    reusing the previous result while that body is unchanged (e.g. after a
+    304 revalidation)
+
+    Like the cache stores' own memos, only the CACHE_MEMO_ENTRIES most
+    recently used results are kept.
+    '''
+    stamp = cache.peek(request_key)
+    stored_at = stamp.stored_at if stamp is not None else None
+    with _PARSED_JSON_LOCK:
+        parsed = _PARSED_JSON.get(request_key)
+        if parsed is not None and stored_at is not None and parsed[0] == stored_at:
+            _PARSED_JSON.move_to_end(request_key)
+            return parsed[1]
+    result = json.loads(text)
+    with _PARSED_JSON_LOCK:
+        _PARSED_JSON[request_key] = (stored_at, result)
+        _PARSED_JSON.move_to_end(request_key)
+        while len(_PARSED_JSON) > CACHE_MEMO_ENTRIES:
+            _PARSED_JSON.popitem(last=False)
+    return result
+
+
+CacheEntry = namedtuple('CacheEntry',
+    ['value', 'stored_at', 'etag', 'last_modified', 'fresh'])
+
+
+class CacheStamp(namedtuple('CacheStamp',
+        ['stored_at', 'etag', 'last_modified', 'data_version', 'fresh'])):
+    '''What CacheStore.peek() returns: an entry without its value'''
+    __slots__ = ()
+
+    @property
+    def version(self):
+        '''identifies the stored value: the version it was stored with, else
+        its ETag or Last-Modified, so a 304 revalidation keeps the same
+        version; otherwise the time it was stored'''
+        return (self.data_version or self.etag or self.last_modified
+            or str(self.stored_at))
+
+
+# parsed values each process keeps per cache store; everything else is read
+# from the shared cache file when it is needed
+CACHE_MEMO_ENTRIES = 16
+# LAST_USED is only rewritten once an entry's is older than this, so reads
+# don't have to write to the shared file
+LAST_USED_RESOLUTION = MINUTE
+# seconds a process may hold the right to fetch a key before others give up
+# waiting for it and fetch it themselves
+FETCH_LEASE_SECONDS = 20
+# seconds a write waits for another process's write to finish
+CACHE_WRITE_TIMEOUT = 10
+# seconds an entry is kept after it goes stale, so it can still be shown
+# (and revalidated) while its source is down; compact() drops older ones
+CACHE_STALE_KEEP = WEEK
+
+
+class CacheStore:
+    '''A key/value cache for one upstream source, kept in its own SQLite file.
+
+    The file is shared by every process of the app (e.g. several gunicorn
+    workers), so an upstream fetch made by one of them is used by all. The
+    file is in WAL mode: each thread reads through its own connection
+    without locking, while writes go through one connection per process
+    and take SQLite's write lock (BEGIN IMMEDIATE), so there is a single
+    writer at a time across processes.
+
+    Each process keeps only the CACHE_MEMO_ENTRIES most recently used
+    values already decoded, and checks their STORED_AT against the file
+    before using one, so memory stays flat as workers are added and a
+    worker never serves a copy another has replaced.
+
+    Entries older than ttl seconds are stale: get() treats them as missing,
+    but get_entry() still returns them along with the ETag/Last-Modified
+    validators they were stored with, so they can be revalidated with a
+    conditional GET. Once the store holds more than max_entries the least
+    recently used entries are evicted, so the file stays bounded too.
+
+    A process about to fetch a missing key takes a lease on it (see
+    acquire_lease), so the other processes wait for its result instead of
+    fetching the same thing.
+    '''
+
+    def __init__(self, path, ttl=None, max_entries=None, name=None):
+        self.path = path
+        self.name = name or path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flight = SingleFlight()
+        self.counters = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'lease_waits': 0}
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._readers = threading.local()
+        self._conn = None
+
+    @property
+    def owner(self):
+        '''identifies this store in this process in FetchLease'''
+        return f'{os.getpid()}:{id(self)}'
+
+    @property
+    def conn(self):
+        '''this process's writer connection, opened (and the cache file
+        created) the first time the store is used rather than at import'''
+        if self._conn is None:
+            with self._open_lock:
+                if self._conn is None:
+                    self._conn = self._open()
+        return self._conn
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=CACHE_WRITE_TIMEOUT,
+            isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(Cache)')]
+            if columns and 'ETAG' not in columns:
+                conn.execute('DROP TABLE Cache')
+            elif columns and 'VERSION' not in columns:
+                conn.execute('ALTER TABLE Cache ADD COLUMN "VERSION" TEXT')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS Cache (
+                    "KEY" TEXT PRIMARY KEY,
+                    "VALUE" TEXT NOT NULL,
+                    "STORED_AT" REAL NOT NULL,
+                    "LAST_USED" REAL NOT NULL,
+                    "ETAG" TEXT,
+                    "LAST_MODIFIED" TEXT,
+                    "VERSION" TEXT
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS Cache_LAST_USED ON Cache ("LAST_USED")
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS FetchLease (
+                    "KEY" TEXT PRIMARY KEY,
+                    "OWNER" TEXT NOT NULL,
+                    "EXPIRES" REAL NOT NULL
+                )
+            ''')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return conn
+
+    @contextlib.contextmanager
+    def _write(self):
+        '''a write transaction on this process's writer connection; the
+        caller holds self._lock'''
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def _reader(self):
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            self.conn  # creates the file and tables if this is the first use
+            conn = sqlite3.connect(self.path, timeout=CACHE_WRITE_TIMEOUT)
+            self._readers.conn = conn
+        return conn
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __len__(self):
+        return self._reader().execute('SELECT COUNT(*) FROM Cache').fetchone()[0]
+
+    def _fresh(self, stored_at, now):
+        return self.ttl is None or now - stored_at <= self.ttl
+
+    def _remember(self, key, row):
+        with self._lock:
+            self._memo[key] = row
+            self._memo.move_to_end(key)
+            while len(self._memo) > CACHE_MEMO_ENTRIES:
+                self._memo.popitem(last=False)
+
+    def _evict(self):
+        if self.max_entries is not None:
+            self.conn.execute('''
+                DELETE FROM Cache WHERE "KEY" IN (
+                    SELECT "KEY" FROM Cache ORDER BY "LAST_USED" DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', [self.max_entries])
+
+    def set(self, key, value, etag=None, last_modified=None, version=None):
+        '''stores value under key with the upstream's validators, and
+        optionally a version of its own for values that are built up rather
+        than stored as served (see CacheStamp.version)'''
+        now = time.time()
+        with self._lock, self._write():
+            self.conn.execute('''
+                INSERT OR REPLACE INTO Cache ("KEY", "VALUE", "STORED_AT", "LAST_USED",
+                    "ETAG", "LAST_MODIFIED", "VERSION")
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [key, json.dumps(value), now, now, etag, last_modified, version])
+            self._evict()
+        self._remember(key, (value, now, etag, last_modified))
+
+    def touch(self, key):
+        '''marks an entry as fresh again, e.g. after the upstream answered
+        a conditional GET with 304 Not Modified
+        '''
+        now = time.time()
+        with self._lock:
+            with self._write():
+                self.conn.execute(
+                    'UPDATE Cache SET "STORED_AT" = ?, "LAST_USED" = ? WHERE "KEY" = ?',
+                    [now, now, key])
+            if key in self._memo:
+                value, stored_at, etag, last_modified = self._memo[key]
+                self._memo[key] = (value, now, etag, last_modified)
+
+    def get_entry(self, key):
+        '''looks up key whether or not it is still fresh
+
+        Parameters
+        ----------
+        key: string
+            the cache key
+
+        Returns
+        -------
+        CacheEntry
+            the stored value, when it was stored, its validators and
+            whether it is still within the ttl, or None if key is unknown
+        '''
+        now = time.time()
+        found = self._row(key)
+        if found is None:
+            return None
+        row, last_used = found
+        if now - last_used > LAST_USED_RESOLUTION:
+            with self._lock, self._write():
+                self.conn.execute('UPDATE Cache SET "LAST_USED" = ? WHERE "KEY" = ?',
+                    [now, key])
+        return CacheEntry(*row, fresh=self._fresh(row[1], now))
+
+    def peek(self, key):
+        '''reads when key was stored, its validators and version and whether
+        it is fresh, without reading the value or marking the entry as used, so
+        checking what is cached is cheap and doesn't write to the cache file
+
+        Returns
+        -------
+        CacheStamp
+            or None if key is unknown
+        '''
+        found = self._reader().execute(
+            '''SELECT "STORED_AT", "ETAG", "LAST_MODIFIED", "VERSION"
+            FROM Cache WHERE "KEY" = ?''',
+            [key]).fetchone()
+        if found is None:
+            return None
+        return CacheStamp(*found, fresh=self._fresh(found[0], time.time()))
+
+    def _row(self, key):
+        '''reads key's (value, stored_at, etag, last_modified) and its
+        LAST_USED, decoding the value only if the memo doesn't already hold
+        the copy that is in the file'''
+        reader = self._reader()
+        found = reader.execute(
+            'SELECT "STORED_AT", "LAST_USED" FROM Cache WHERE "KEY" = ?', [key]).fetchone()
+        if found is None:
+            return None
+        stored_at, last_used = found
+        with self._lock:
+            row = self._memo.get(key)
+            if row is not None and row[1] == stored_at:
+                self._memo.move_to_end(key)
+                return row, last_used
+        found = reader.execute('''
+            SELECT "VALUE", "STORED_AT", "ETAG", "LAST_MODIFIED", "LAST_USED"
+            FROM Cache WHERE "KEY" = ?
+        ''', [key]).fetchone()
+        if found is None:
+            return None
+        row = (json.loads(found[0]), found[1], found[2], found[3])
+        self._remember(key, row)
+        return row, found[4]
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        if entry is None or not entry.fresh:
+            return default
+        return entry.value
+
+    def keys(self):
+        return [row[0] for row in self._reader().execute('SELECT "KEY" FROM Cache')]
+
+    def acquire_lease(self, key):
+        '''claims the right to fetch key for FETCH_LEASE_SECONDS, across
+        every process sharing the cache file
+
+        Returns
+        -------
+        bool
+            False while another process holds an unexpired lease on key
+        '''
+        now = time.time()
+        with self._lock, self._write():
+            row = self.conn.execute(
+                'SELECT "OWNER", "EXPIRES" FROM FetchLease WHERE "KEY" = ?', [key]).fetchone()
+            if row is not None and row[0] != self.owner and row[1] > now:
+                return False
+            self.conn.execute('INSERT OR REPLACE INTO FetchLease VALUES (?, ?, ?)',
+                [key, self.owner, now + FETCH_LEASE_SECONDS])
+        return True
+
+    def release_lease(self, key):
+        with self._lock, self._write():
+            self.conn.execute('DELETE FROM FetchLease WHERE "KEY" = ? AND "OWNER" = ?',
+                [key, self.owner])
+
+    def lease_expires(self, key):
+        '''when another process's lease on key runs out, or None if there
+        is no lease'''
+        row = self._reader().execute(
+            'SELECT "EXPIRES" FROM FetchLease WHERE "KEY" = ?', [key]).fetchone()
+        return row[0] if row is not None else None
+
+    def record(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        '''returns the hit/miss counters, including how many misses were
+        coalesced onto another request's fetch (in this process) or waited
+        for another process's fetch
+        '''
+        with self._lock:
+            stats = dict(self.counters)
+        stats['coalesced'] = self.flight.coalesced
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_ratio'] = round((stats['hits'] + stats['stale_hits']) / lookups, 3) if lookups else None
+        return stats
+
+    def compact(self):
+        '''drops entries that have been stale for CACHE_STALE_KEEP and
+        expired leases, folds the write-ahead log back into the cache file
+        and reclaims the space left by replaced entries
+        '''
+        with self._lock:
+            with self._write():
+                if self.ttl is not None:
+                    self.conn.execute('DELETE FROM Cache WHERE "STORED_AT" < ?',
+                        [time.time() - self.ttl - CACHE_STALE_KEEP])
+                self.conn.execute('DELETE FROM FetchLease WHERE "EXPIRES" < ?', [time.time()])
+                self._evict()
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.conn.execute('VACUUM')
+            self._memo.clear()
+
+    def clear(self):
+        '''drops every entry'''
+        with self._lock:
+            with self._write():
+                self.conn.execute('DELETE FROM Cache')
+                self.conn.execute('DELETE FROM FetchLease')
+            self._memo.clear()
+
+
+def load_cache(cache_file, ttl=None, max_entries=None, name=None):
+    '''describes the cache store kept in cache_file (the file is opened
+    the first time the store is used)
 
     Parameters:
-    cache_dict: dict
-        Information to save
+    cache_file: string
+        name of the SQLite file for this source
+    ttl: int
+        seconds an entry stays fresh, or None to keep entries forever
+    max_entries: int
+        most entries to keep before evicting the least recently used
+    name: string
+        what the source is called on pages and in the refresh status
 
     Returns:
-    None
+    CacheStore
     '''
-    contents_to_write = json.dumps(cache_dict)
-    cache_file = open(CACHE_FILE_NAME, 'w')
-    cache_file.write(contents_to_write)
-    cache_file.close()
+    return CacheStore(cache_file, ttl=ttl, max_entries=max_entries, name=name)
+
+
+COVID_CACHE = load_cache(CACHE_FILE_NAME, COVID_CACHE_TTL, COVID_CACHE_MAX_ENTRIES,
+    'COVID-19 stats')
+STATE_COV_CACHE = load_cache(STATE_CACHE_NAME, STATE_CACHE_TTL, STATE_CACHE_MAX_ENTRIES,
+    'state info')
+URL_CACHE = load_cache(KFF_CACHE_NAME, KFF_CACHE_TTL, KFF_CACHE_MAX_ENTRIES,
+    'KFF pages')
+TWITTER_CACHE_DICT = load_cache(TWITTER_CACHE_FILENAME, TWITTER_CACHE_TTL, TWITTER_CACHE_MAX_ENTRIES,
+    'Tweets')
+NEWS_CACHE_DICT = load_cache(NEWS_CACHE_FILENAME, NEWS_CACHE_TTL, NEWS_CACHE_MAX_ENTRIES,
+    'headlines')
+
+ALL_CACHES = [COVID_CACHE, STATE_COV_CACHE, URL_CACHE, TWITTER_CACHE_DICT, NEWS_CACHE_DICT]
 
 
 def make_request_using_cache(url, params, cache):
     request_key = construct_unique_key(url, params=params)
-    if request_key in cache.keys():
-        print("Using cache")
-        return cache[request_key]
-    else:
-        print("Fetching")
-        time.sleep(1)
-        response = requests.get(url, params=params)
-        cache[request_key] = response.text
-        save_cache(cache)
-        return cache[request_key]
+    return fetch_using_cache(url, params, cache, request_key)
 
 
 def construct_unique_key(baseurl, params):
@@ -142,90 +1284,92 @@ def construct_unique_key(baseurl, params):
     connector = '_'
     for k in params.keys():
         param_strings.append(f'{k}_{params[k]}')
-    unique_key = baseurl + connector + connector.join(param_strings) + connector + str(date.today())
+    unique_key = baseurl + connector + connector.join(param_strings)
     return unique_key
 
 
-def make_twitter_request(baseurl, params):
-    '''Make a request to the Web API using the baseurl and params
+CDC_ACCOUNT = 'from:@CDCgov'
+TWEETS_PER_ACCOUNT = 5
+# Tweets kept per account, and the most asked for in one request
+TIMELINE_SIZE = 20
 
-    Parameters
-    ----------
-    baseurl: string
-        The URL for the API endpoint
-    params: dictionary
-        A dictionary of param:value pairs
 
-    Returns
-    -------
-    string
-        the data returned from making the request in the form of
-        a dictionary
+class TimelineUpdate:
+    '''Keeps an account's Tweet timeline up to date incrementally.
+
+    Passed to fetch_using_cache as its extract, it makes revalidate() ask
+    Twitter only for Tweets newer than the stored since_id and merge them
+    into the stored timeline. A timeline is stored as
+    {'since_id': newest id, 'tweets': [[id, created_at, text], ...]},
+    newest first and capped at size entries, so only what the pages show
+    is kept.
     '''
-    response = requests.get(TWITTER_BASEURL, params=params, auth=oauth)
-    return response.json()
 
+    def __init__(self, size=TIMELINE_SIZE):
+        self.size = size
+
+    def params(self, params, previous):
+        if previous is None or previous['since_id'] is None:
+            return params
+        return dict(params, since_id=previous['since_id'])
+
+    def merge(self, previous, text):
+        tweets = [[tweet['id'], tweet.get('created_at'), tweet['text']]
+            for tweet in json.loads(text)['statuses']]
+        seen = {tweet[0] for tweet in tweets}
+        if previous is not None:
+            tweets += [tweet for tweet in previous['tweets'] if tweet[0] not in seen]
+        tweets.sort(key=lambda tweet: tweet[0], reverse=True)
+        del tweets[self.size:]
+        since_id = tweets[0][0] if tweets else None
+        return {'since_id': since_id, 'tweets': tweets}
 
-def make_twitter_request_with_cache(baseurl, params):
-    '''Check the cache for a saved result for baseurl+params:values
-    combo. If the result is found, return it. Otherwise send a new
-    request, save it, then return it.
+
+TIMELINE_UPDATE = TimelineUpdate()
+
+
+def tweets_request_key(account):
+    '''the TWITTER_CACHE_DICT key an account's timeline is stored under'''
+    return construct_unique_key(TWITTER_BASEURL, dict(q=account))
+
+
+def get_timeline(account):
+    '''returns an account's stored timeline (see TimelineUpdate), fetching
+    just the Tweets posted since it was last refreshed when it is stale
 
     Parameters
     ----------
-    baseurl: string
-        The URL for the API endpoint
     account: string
-        account to search for
-    count: int
-        the number of tweets to retrieve
+        the search query for the account, e.g. "from:@CDCgov"
 
     Returns
     -------
-    string
-        the results of the query loaded from cache
+    dict
     '''
-    request_key = construct_unique_key(TWITTER_BASEURL, params)
-    if request_key in TWITTER_CACHE_DICT.keys():
-        print("Using Cache")
-        return TWITTER_CACHE_DICT[request_key]
-    else:
-        print("Calling API")
-        TWITTER_CACHE_DICT[request_key] = make_twitter_request(TWITTER_BASEURL, params)
-        save_cache(TWITTER_CACHE_DICT)
-        return TWITTER_CACHE_DICT[request_key]
-
-
-TWITTER_CACHE_DICT = load_cache('state_cov_info_cache.json')
+    params = dict(q=account, count=TIMELINE_SIZE)
+    return fetch_using_cache(TWITTER_BASEURL, params, TWITTER_CACHE_DICT,
+        tweets_request_key(account), auth=get_oauth(), extract=TIMELINE_UPDATE)
 
 
 def find_tweets(TWITTER_BASEURL, account, count):
-    ''' Finds the hashtag that most commonly co-occurs with the hashtag
-    queried in make_request_with_cache().
+    ''' Finds the most recent Tweets from an account.
 
     Parameters
     ----------
-    tweet_data: dict
-        Twitter data as a dictionary for a specific query
-    hashtag_to_ignore: string
-        the same hashtag that is queried in make_request_with_cache()
-        (e.g. "#election2020")
+    TWITTER_BASEURL: string
+        the Twitter search endpoint
+    account: string
+        the search query for the account, e.g. "from:@CDCgov"
+    count: int
+        how many Tweets to return (at most TIMELINE_SIZE)
 
     Returns
     -------
-    string
-        the hashtag that most commonly co-occurs with the hashtag
-        queried in make_request_with_cache()
-
+    list
+        the text of the account's newest Tweets, newest first
     '''
-    tweet_list = []
-    params= dict(q=account, count=count)
-    results = make_twitter_request_with_cache(TWITTER_BASEURL, params)
-    tweets = results['statuses']
-    for tweet in tweets:
-        tweet_text = tweet['text']
-        tweet_list.append(tweet_text)
-    return tweet_list
+    timeline = get_timeline(account)
+    return [text for tweet_id, created_at, text in timeline['tweets'][:count]]
 
 
 def get_covid_data(call_type, state=None):
@@ -243,11 +1387,141 @@ def get_covid_data(call_type, state=None):
         a converted API return from COVID API
     '''
     params = {'state': state}
-    results = make_request_using_cache(COVID_BASE_URL+call_type, params, COVID_CACHE)
-    json_results = json.loads(results)
+    if call_type == "info":
+        cache = STATE_COV_CACHE
+    else:
+        cache = COVID_CACHE
+    results = make_request_using_cache(COVID_BASE_URL+call_type, params, cache)
+    request_key = construct_unique_key(COVID_BASE_URL+call_type, params)
+    json_results = parse_json_once(cache, request_key, results)
     return json_results
 
 
+def covid_data_version(state):
+    '''identifies the version of a state's COVID series
+
+    Series loaded into the DailyCovid table are versioned by the table (see
+    warehouse_version). Otherwise the ETag or Last-Modified header it was served with is used when there
+    is one, so a 304 revalidation keeps the same version; otherwise the time
+    the body was stored.
+
+    Parameters
+    ----------
+    state: string
+        the state's two letter abbreviation
+
+    Returns
+    -------
+    string
+        the version, or None if the series has not been fetched
+    '''
+    version = warehouse_version(state)
+    if version is not None:
+        return version
+    request_key = construct_unique_key(COVID_BASE_URL+"daily", {'state': state})
+    stamp = COVID_CACHE.peek(request_key)
+    if stamp is None:
+        return None
+    return stamp.version
+
+
+# the columns kept for each state, and the API field each comes from
+SERIES_FIELDS = [
+    ('positive', 'positive'),
+    ('hospitalized', 'hospitalizedCurrently'),
+    ('recovered', 'recovered'),
+    ('deaths', 'death'),
+]
+
+StateSeries = namedtuple('StateSeries',
+    ['dates'] + [field for field, api_field in SERIES_FIELDS])
+
+
+def parse_covid_dates(date_ints):
+    '''converts the API's YYYYMMDD integers to datetime64[D] in one pass
+
+    Parameters
+    ----------
+    date_ints: numpy array
+        dates as integers such as 20200420
+
+    Returns
+    -------
+    numpy array
+        the same dates as datetime64[D]
+    '''
+    years = date_ints // 10000
+    months = date_ints // 100 % 100
+    days = date_ints % 100
+    month_starts = ((years - 1970) * 12 + months - 1).astype('datetime64[M]')
+    return month_starts.astype('datetime64[D]') + (days - 1)
+
+
+def covid_date_ints(dates):
+    '''the inverse of parse_covid_dates'''
+    month_starts = dates.astype('datetime64[M]')
+    years = month_starts.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = month_starts.astype(np.int64) % 12 + 1
+    days = (dates - month_starts.astype('datetime64[D]')).astype(np.int64) + 1
+    return years * 10000 + months * 100 + days
+
+
+def build_state_series(results):
+    '''Turns the API's list of daily records into a StateSeries.
+
+    Missing and null counts become 0, and the rows are sorted oldest first.
+
+    Parameters
+    ----------
+    results: list
+        daily records for one state from the COVID API
+
+    Returns
+    -------
+    StateSeries
+        a datetime64 date array and an int64 array per count
+    '''
+    n = len(results)
+    date_ints = np.fromiter((r['date'] for r in results), dtype=np.int64, count=n)
+    order = np.argsort(date_ints, kind='stable')
+    columns = [parse_covid_dates(date_ints[order])]
+    for field, api_field in SERIES_FIELDS:
+        values = np.fromiter((r.get(api_field) or 0 for r in results),
+            dtype=np.int64, count=n)
+        columns.append(values[order])
+    return StateSeries(*columns)
+
+
+# state -> (COVID data version, StateSeries)
+_SERIES_CACHE = {}
+
+
+def get_state_series(state):
+    '''returns the StateSeries for a state, rebuilding it only when the
+    state's COVID data has changed since it was last built
+
+    The series is read from the DailyCovid table when the bulk ingest has
+    loaded the state, and fetched from the per-state API otherwise. The
+    version is checked first, so while it is fresh and unchanged nothing
+    is read from the cache or parsed.
+    '''
+    version = fresh_covid_version(state)
+    cached = _SERIES_CACHE.get(state)
+    if version is not None and cached is not None and cached[0] == version:
+        return cached[1]
+    if version is not None and version.startswith('db:'):
+        series = read_state_series(state)
+    else:
+        results = get_covid_data("daily", state=state)
+        version = covid_data_version(state)
+        if cached is not None and cached[0] == version:
+            # revalidated unchanged, or served stale while it refreshes
+            return cached[1]
+        series = build_state_series(results)
+    _SERIES_CACHE[state] = (version, series)
+    return series
+
+
 def get_covid_state_data(input_state):
     '''Obtain API data on daily counts of COVID cases.
 
@@ -260,63 +1534,308 @@ def get_covid_state_data(input_state):
     Returns
     -------
     dict
-        a converted API return from COVID API
+        a converted API return from COVID API, newest date first
     '''
-    results = get_covid_data("daily", state=input_state)
-    state_covid_cases = {}
-    state = results[0]['state']
-    state_covid_cases[state] = {}
-    for group in results:
-        date = group['date']
-        state_covid_cases[state][date] = {}
-        state_covid_cases[state][date]['positive cases'] = group['positive']
-        if 'hospitalizedCurrently' in group.keys():
-            if group['hospitalizedCurrently'] == None:
-                state_covid_cases[state][date]['currently hospitalized'] = 0
-            else:
-                state_covid_cases[state][date]['currently hospitalized'] = group['hospitalizedCurrently']
-        else:
-            state_covid_cases[state][date]['currently hospitalized'] = 0
-        if 'recovered' in group.keys():
-            if group['recovered'] == None:
-                state_covid_cases[state][date]['recovered'] = 0
-            else:
-                state_covid_cases[state][date]['recovered'] = group['recovered']
-        else:
-            state_covid_cases[state][date]['recovered'] = 0
-        if 'death' in group.keys():
-            state_covid_cases[state][date]['deaths'] = group['death']
-        else:
-            state_covid_cases[state][date]['deaths'] = 0
+    series = get_state_series(input_state)
+    rows = zip(covid_date_ints(series.dates).tolist(), series.positive.tolist(),
+        series.hospitalized.tolist(), series.recovered.tolist(),
+        series.deaths.tolist())
+    state_covid_cases = {input_state: {}}
+    for date, positive, hospitalized, recovered, deaths in reversed(list(rows)):
+        state_covid_cases[input_state][date] = {
+            'positive cases': positive,
+            'currently hospitalized': hospitalized,
+            'recovered': recovered,
+            'deaths': deaths,
+        }
     return state_covid_cases
 
 
+def series_window(series, start=None, end=None):
+    '''returns the (lo, hi) slice bounds of series.dates that fall between
+    start and end (datetime64[D], both inclusive; None leaves that side open)'''
+    lo = 0 if start is None else np.searchsorted(series.dates, start, side='left')
+    hi = len(series.dates) if end is None else np.searchsorted(series.dates, end, side='right')
+    return int(lo), int(hi)
+
+
+def covid_table_rows(series, start=None, end=None):
+    '''yields (dateint, counts) rows for the COVID stats table, newest date
+    first, limited to the dates between start and end
+
+    Rows are produced one at a time so a streamed page can send the first
+    ones before the rest of the history has been formatted.
+    '''
+    lo, hi = series_window(series, start, end)
+    dates = covid_date_ints(series.dates[lo:hi])
+    for i in range(hi - lo - 1, -1, -1):
+        yield int(dates[i]), {
+            'positive cases': int(series.positive[lo + i]),
+            'currently hospitalized': int(series.hospitalized[lo + i]),
+            'recovered': int(series.recovered[lo + i]),
+            'deaths': int(series.deaths[lo + i]),
+        }
+
+
 def plotly_lists(state):
-    pos_cases_list = []
-    cur_hosp_list = []
-    recov_list = []
-    deaths_list = []
-    state_string = str(state)
-    state_info = get_covid_state_data(state_string)
-    for key, values in state_info[state_string].items():
-        for key, value in values.items():
-            if key == 'positive cases':
-                pos_cases_list.append(value)
-            if key == 'currently hospitalized':
-                cur_hosp_list.append(value)
-            if key == 'recovered':
-                recov_list.append(value)
-            if key == 'deaths':
-                deaths_list.append(value)
+    series = get_state_series(str(state))
+    pos_cases_list = series.positive[::-1].tolist()
+    cur_hosp_list = series.hospitalized[::-1].tolist()
+    recov_list = series.recovered[::-1].tolist()
+    deaths_list = series.deaths[::-1].tolist()
     return pos_cases_list, cur_hosp_list, recov_list, deaths_list
 
 
-def build_state_url_dict():
-    ''' Make a dictionary that maps state name to state page url from "https://www.kff.org/statedata"
+METRIC_WINDOW = 7
+PER_CAPITA = 100000
+
+StateMetrics = namedtuple('StateMetrics', ['version', 'dates', 'positive',
+    'new_cases', 'new_cases_avg', 'doubling_days', 'hosp_per_icu_bed',
+    'hosp_bed_share', 'new_cases_per_100k'])
+
+
+def _doubling_days(positive_now, positive_before, window):
+    '''days for cases to double at the growth rate seen over window days;
+    NaN where cases did not grow
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = positive_now / positive_before
+        days = window * np.log(2) / np.log(growth)
+    return np.where(growth > 1, days, np.nan)
+
+
+def _forward_fill(table):
+    '''fills each row's NaNs with the last value before them (leading
+    NaNs stay NaN)'''
+    present = ~np.isnan(table)
+    last = np.where(present, np.arange(table.shape[1]), 0)
+    np.maximum.accumulate(last, axis=1, out=last)
+    return table[np.arange(table.shape[0])[:, None], last]
+
+
+def _beds(profile):
+    '''(ICU beds, hospital beds, estimated population) from a StateProfile,
+    NaN where unknown'''
+    if profile is None:
+        return np.nan, np.nan, np.nan
+    return tuple(np.nan if value is None else float(value)
+        for value in (profile.icu_beds, profile.hosp_beds, profile.est_population))
+
+
+def compute_state_metrics(series_by_state, profiles, versions):
+    '''Computes the derived metrics for many states in one batched pass.
+
+    Every state's series is laid out as one row of a 2D array over a
+    calendar date axis, so daily deltas, rolling means, doubling times,
+    the load on ICU and hospital beds and per-capita rates are computed
+    with a handful of array operations for all states at once instead of
+    a loop per state. Days missing from a state's history are filled with
+    its previous count, so a state's metrics don't depend on which other
+    states are in the batch.
 
     Parameters
     ----------
-    None
+    series_by_state: dict
+        state abbreviation -> StateSeries
+    profiles: dict
+        state abbreviation -> StateProfile (or None), for the bed counts
+        and population
+    versions: dict
+        state abbreviation -> the COVID data version the series came from
+
+    Returns
+    -------
+    dict
+        state abbreviation -> StateMetrics
+    '''
+    states = [state for state, series in series_by_state.items() if len(series.dates)]
+    if not states:
+        return {}
+    first = min(series_by_state[s].dates[0] for s in states)
+    last = max(series_by_state[s].dates[-1] for s in states)
+    all_dates = np.arange(first, last + np.timedelta64(1, 'D'))
+    reported = np.full((len(states), len(all_dates)), np.nan)
+    hospitalized = np.full((len(states), len(all_dates)), np.nan)
+    for row, state in enumerate(states):
+        series = series_by_state[state]
+        columns = (series.dates - first).astype(np.int64)
+        reported[row, columns] = series.positive
+        hospitalized[row, columns] = series.hospitalized
+    present = ~np.isnan(reported)
+    positive = _forward_fill(reported)
+
+    new_cases = np.diff(positive, axis=1, prepend=np.nan)
+    new_cases_avg = np.full_like(new_cases, np.nan)
+    if len(all_dates) >= METRIC_WINDOW:
+        windows = np.lib.stride_tricks.sliding_window_view(new_cases, METRIC_WINDOW, axis=1)
+        new_cases_avg[:, METRIC_WINDOW - 1:] = windows.mean(axis=-1)
+    positive_before = np.full_like(positive, np.nan)
+    positive_before[:, METRIC_WINDOW:] = positive[:, :-METRIC_WINDOW]
+    doubling_days = _doubling_days(positive, positive_before, METRIC_WINDOW)
+    icu_beds, hosp_beds, population = np.array(
+        [_beds(profiles.get(s)) for s in states]).T[:, :, None]
+    hosp_per_icu_bed = hospitalized / icu_beds
+    hosp_bed_share = hospitalized / hosp_beds
+    new_cases_per_100k = new_cases_avg * PER_CAPITA / population
+
+    metrics = {}
+    for row, state in enumerate(states):
+        days = present[row]
+        metrics[state] = StateMetrics(versions.get(state), all_dates[days],
+            positive[row, days], new_cases[row, days],
+            new_cases_avg[row, days], doubling_days[row, days],
+            hosp_per_icu_bed[row, days], hosp_bed_share[row, days],
+            new_cases_per_100k[row, days])
+    return metrics
+
+
+def extend_state_metrics(metrics, series, profile, version):
+    '''Appends the newest day to a state's metrics without recomputing its
+    history.
+
+    Only the last METRIC_WINDOW days are needed for the new values, so
+    this is only used when those days are consecutive (see
+    get_state_metrics).
+
+    Parameters
+    ----------
+    metrics: StateMetrics
+        the metrics computed for all but the last day of series
+    series: StateSeries
+        the state's series with one day more than metrics
+    profile: StateProfile
+        the state's profile, or None
+    version: string
+        the COVID data version of series
+
+    Returns
+    -------
+    StateMetrics
+        metrics including the newest day
+    '''
+    positive = series.positive[-(METRIC_WINDOW + 1):].astype(float)
+    new_case = positive[-1] - positive[-2] if len(positive) > 1 else np.nan
+    recent = np.append(metrics.new_cases[-(METRIC_WINDOW - 1):], new_case)
+    new_case_avg = recent.mean() if len(recent) == METRIC_WINDOW else np.nan
+    if len(positive) > METRIC_WINDOW:
+        doubling = _doubling_days(positive[-1:], positive[:1], METRIC_WINDOW)[0]
+    else:
+        doubling = np.nan
+    icu_beds, hosp_beds, population = _beds(profile)
+    hospitalized = float(series.hospitalized[-1])
+    return StateMetrics(version,
+        np.append(metrics.dates, series.dates[-1]),
+        np.append(metrics.positive, positive[-1]),
+        np.append(metrics.new_cases, new_case),
+        np.append(metrics.new_cases_avg, new_case_avg),
+        np.append(metrics.doubling_days, doubling),
+        np.append(metrics.hosp_per_icu_bed, hospitalized / icu_beds),
+        np.append(metrics.hosp_bed_share, hospitalized / hosp_beds),
+        np.append(metrics.new_cases_per_100k, new_case_avg * PER_CAPITA / population))
+
+
+# state -> StateMetrics
+STATE_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+
+
+def refresh_all_state_metrics(states=None):
+    '''recomputes the metrics in one batch and stores them in STATE_METRICS
+
+    By default that is every state loaded into DailyCovid, plus the states
+    fetched from the per-state API whose metrics are already stored.
+    '''
+    series_by_state = read_all_state_series()
+    if states is None:
+        states = set(series_by_state) | set(STATE_METRICS)
+    for state in states:
+        if state not in series_by_state:
+            series_by_state[state] = get_state_series(state)
+    series_by_state = {state: series_by_state[state] for state in states}
+    versions = {state: covid_data_version(state) for state in states}
+    profiles = {state: get_state_profile(state) for state in states}
+    STATE_METRICS.update(compute_state_metrics(series_by_state, profiles, versions))
+
+
+def get_state_metrics(state):
+    '''Returns a state's StateMetrics, normally straight from STATE_METRICS.
+
+    When DailyCovid has been (re)loaded, every state in it is recomputed
+    in one batch. For a state from the per-state API whose data gained
+    exactly one new day, the stored metrics are extended in place; any
+    other change recomputes that state.
+    '''
+    series = get_state_series(state)
+    version = covid_data_version(state)
+    metrics = STATE_METRICS.get(state)
+    if metrics is not None and metrics.version == version:
+        return metrics
+    if version is not None and version.startswith('db:'):
+        with _METRICS_LOCK:
+            metrics = STATE_METRICS.get(state)
+            if metrics is None or metrics.version != version:
+                refresh_all_state_metrics()
+        return STATE_METRICS.get(state)
+    profile = get_state_profile(state)
+    day = np.timedelta64(1, 'D')
+    if (metrics is not None and len(series.dates) == len(metrics.dates) + 1
+            and np.array_equal(series.dates[:-1], metrics.dates)
+            and np.array_equal(series.positive[:-1], metrics.positive)
+            and np.all(np.diff(series.dates[-(METRIC_WINDOW + 1):]) == day)):
+        metrics = extend_state_metrics(metrics, series, profile, version)
+    else:
+        metrics = compute_state_metrics({state: series}, {state: profile},
+            {state: version}).get(state)
+    STATE_METRICS[state] = metrics
+    return metrics
+
+
+def latest_state_metrics(state):
+    '''the most recent day's metrics for a state, formatted for display'''
+    metrics = get_state_metrics(state)
+    if metrics is None:
+        return None
+
+    def show(value, fmt):
+        return 'n/a' if np.isnan(value) else fmt.format(value)
+
+    return {
+        'date': str(metrics.dates[-1]),
+        'new_cases': show(metrics.new_cases[-1], '{:,.0f}'),
+        'new_cases_avg': show(metrics.new_cases_avg[-1], '{:,.1f}'),
+        'doubling_days': show(metrics.doubling_days[-1], '{:,.1f} days'),
+        'hosp_per_icu_bed': show(metrics.hosp_per_icu_bed[-1], '{:.2f}'),
+        'hosp_bed_share': show(metrics.hosp_bed_share[-1] * 100, '{:.1f}%'),
+        'new_cases_per_100k': show(metrics.new_cases_per_100k[-1], '{:,.1f}'),
+    }
+
+
+AT_RISK_POP_URL = 'https://www.kff.org/global-health-policy/issue-brief/how-many-adults-are-at-risk-of-serious-illness-if-infected-with-coronavirus/'
+AT_RISK_NAME_STYLE = 'width: 87px'
+AT_RISK_STAT_STYLE = 'width: 62px;text-align: center'
+
+
+@functools.lru_cache(maxsize=None)
+def html_parser():
+    '''the BeautifulSoup parser to use: lxml when it is installed, since it
+    is much faster, otherwise the standard library's'''
+    try:
+        import lxml
+    except ImportError:
+        return 'html.parser'
+    return 'lxml'
+
+
+def parse_state_url_dict(page_text):
+    '''Reads the state picker on "https://www.kff.org/statedata" into a
+    dictionary of state page urls.
+
+    Only the <select class="geo-picker"> element is parsed.
+
+    Parameters
+    ----------
+    page_text: string
+        the HTML of STATE_DATA_URL
 
     Returns
     -------
@@ -324,8 +1843,9 @@ def build_state_url_dict():
         key is a state name and value is the url
     '''
     state_url_dict = {}
-    response = requests.get(STATE_DATA_URL)
-    soup = BeautifulSoup(response.text, 'html.parser')
+    from bs4 import BeautifulSoup, SoupStrainer
+    only_picker = SoupStrainer('select', class_='geo-picker')
+    soup = BeautifulSoup(page_text, html_parser(), parse_only=only_picker)
 
     state_dropdown_menu = soup.find('select', class_='geo-picker')
     states_in_menu = state_dropdown_menu.find_all('option')
@@ -342,45 +1862,54 @@ def build_state_url_dict():
     return state_url_dict
 
 
-def make_url_request_using_cache(url, cache):
-    if (url in cache.keys()): # the url is our unique key
-        print("Using cache")
-        return cache[url]
-    else:
-        print("Fetching")
-        time.sleep(1)
-        response = requests.get(url, headers=headers)
-        cache[url] = response.text
-        save_cache(cache)
-        return cache[url]
+def build_state_url_dict():
+    ''' Make a dictionary that maps state name to state page url from "https://www.kff.org/statedata"
+
+    The page is cached as the extracted dictionary rather than as HTML.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    dict
+        key is a state name and value is the url
+    '''
+    return fetch_using_cache(STATE_DATA_URL, None, URL_CACHE,
+        f'{STATE_DATA_URL}|state_urls', extract=parse_state_url_dict)
+
+
+def parse_at_risk_pop(page_text):
+    '''Reads the at-risk population table from the KFF issue brief.
+
+    Only the table cells with the name and percentage styles are parsed,
+    and the two columns are paired in order.
+
+    Parameters
+    ----------
+    page_text: string
+        the HTML of AT_RISK_POP_URL
+
+    Returns
+    -------
+    list
+        [state name, percent at risk] rows
+    '''
+    from bs4 import BeautifulSoup, SoupStrainer
+    only_cells = SoupStrainer('td', style=[AT_RISK_NAME_STYLE, AT_RISK_STAT_STYLE])
+    soup = BeautifulSoup(page_text, html_parser(), parse_only=only_cells)
+    name = soup.find_all('td', style=AT_RISK_NAME_STYLE)
+    stats = soup.find_all('td', style=AT_RISK_STAT_STYLE)
+    state_names = [n.string for n in name[2:]]
+    state_stats = [stat.string for stat in stats[1:]]
+    return [[state, stat] for state, stat in zip(state_names, state_stats)]
 
 
 def extract_at_risk_pop():
-    state_names = []
-    state_stats = []
-    at_risk_pop = {}
-    site_url_key = 'https://www.kff.org/global-health-policy/issue-brief/how-many-adults-are-at-risk-of-serious-illness-if-infected-with-coronavirus/'
-    url_text = make_url_request_using_cache(site_url_key, URL_CACHE)
-    soup = BeautifulSoup(url_text, 'html.parser')
-    name = soup.find_all('td', style='width: 87px')
-    stats = soup.find_all('td', style='width: 62px;text-align: center')
-    for n in name[2:]:
-        state_names.append(n.string)
-    for stat in stats[1:]:
-        state_stats.append(stat.string)
-    for state in state_names:
-        for stat in state_stats:
-            at_risk_pop[state] = stat
-            state_stats.remove(stat)
-            break
-    return at_risk_pop
-
-
-def write_csv(py_dict, csv_file):
-    with open(csv_file, mode='w') as csv_file:
-        writer = csv.writer(csv_file)
-        for key, value in py_dict.items():
-            writer.writerow([value])
+    rows = fetch_using_cache(AT_RISK_POP_URL, None, URL_CACHE,
+        f'{AT_RISK_POP_URL}|at_risk_pop', extract=parse_at_risk_pop)
+    return dict(rows)
 
 
 '''
@@ -389,325 +1918,994 @@ CREATING THE DATABASES
 
 DB_NAME = "covid_state_info.sqlite"
 
-def create_db():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+_db_local = threading.local()
 
-    drop_risk_sql = '''
-        DROP TABLE IF EXISTS AtRiskPopulation;
-    '''
 
-    create_risk_sql = '''
-        CREATE TABLE IF NOT EXISTS AtRiskPopulation (
-            "Id"        INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
-            "STATE" TEXT NOT NULL,
-            "PCT_AT_RISK_POPULATION"  TEXT NOT NULL
-        );
-    '''
+def get_db_connection():
+    '''returns this thread's read-only connection to DB_NAME, opening it
+    the first time the thread asks so requests don't pay for a new
+    connection
 
-    drop_obese_sql = '''
-        DROP TABLE IF EXISTS ObesePopulation;
+    If another process (the ingest command) has committed to the database
+    since this connection last looked, the memoized state profiles are
+    dropped.
     '''
-
-    create_obese_sql = '''
-        CREATE TABLE IF NOT EXISTS ObesePopulation (
-            "STATE" TEXT NOT NULL,
-            "OBESE_POPULATION"  INT NOT NULL,
-            "PCT MALE" INT NOT NULL,
-            "PCT FEMALE" INT NOT NULL
-        );
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        if not os.path.exists(DB_NAME):
+            raise RuntimeError(f"{DB_NAME} does not exist yet, "
+                "run `flask --app final_project_app ingest` first")
+        conn = sqlite3.connect(f'file:{DB_NAME}?mode=ro', uri=True)
+        _db_local.conn = conn
+        _db_local.data_version = None
+    data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+    if data_version != _db_local.data_version:
+        if _db_local.data_version is not None:
+            clear_state_profiles()
+        _db_local.data_version = data_version
+    return conn
+
+
+class StateProfile(namedtuple('StateProfile', ['abbrv', 'name', 'pct_at_risk',
+        'obese_pop', 'icu_beds', 'hosp_beds', 'twitter', 'est_population'])):
+    '''The reference data shown for a state, from every table in DB_NAME
+
+    est_population is worked out from the hospital beds and beds per 1,000
+    people in HospBeds, the only population figure the tables have.
     '''
+    __slots__ = ()
 
-    drop_icu_sql = '''
-        DROP TABLE IF EXISTS ICUBeds;
-    '''
+    @property
+    def obese_pct(self):
+        if self.obese_pop is None:
+            return None
+        return f'{round(self.obese_pop*100,1)}%'
 
-    create_icu_sql = '''
-        CREATE TABLE IF NOT EXISTS ICUBeds (
-            "STATE" TEXT NOT NULL,
-            "ICU_BEDS"  INT NOT NULL,
-            "ICU_BEDS_PER_10K" INT NOT NULL
-        );
-    '''
 
-    drop_hosp_sql = '''
-        DROP TABLE IF EXISTS HospBeds;
-    '''
+_STATE_PROFILES = {}
+
+
+def clear_state_profiles():
+    '''forgets the memoized profiles; called whenever the tables are reloaded'''
+    _STATE_PROFILES.clear()
+
 
-    create_hosp_sql = '''
-        CREATE TABLE IF NOT EXISTS HospBeds (
-            "STATE" TEXT NOT NULL,
-            "TOTAL_BEDS"  INT NOT NULL,
-            "BEDS_PER_1K" INT NOT NULL
-        );
+def get_state_profile(state):
+    '''Looks up everything the pages show about a state.
+
+    Every state's profile is read in one query the first time one is
+    needed and memoized in the process, because the tables only change
+    when the ingest command reloads them. Unknown abbreviations are not
+    remembered, so they can't grow the memo.
+
+    Parameters
+    ----------
+    state: string
+        the state's two letter abbreviation
+
+    Returns
+    -------
+    StateProfile
+        the state's profile, or None if the abbreviation is unknown
+    '''
+    conn = get_db_connection()
+    if _STATE_PROFILES:
+        return _STATE_PROFILES.get(state)
+    q = '''
+        SELECT StateInfo.STATE_ABBRV, StateInfo.STATE_NAME,
+            AtRiskPopulation.PCT_AT_RISK_POPULATION,
+            ObesePopulation.OBESE_POPULATION,
+            ICUBeds.ICU_BEDS,
+            HospBeds.TOTAL_BEDS,
+            StateInfo.TWITTER,
+            CAST(ROUND(HospBeds.TOTAL_BEDS * 1000.0 / NULLIF(HospBeds.BEDS_PER_1K, 0))
+                AS INTEGER)
+        FROM StateInfo
+        LEFT JOIN AtRiskPopulation ON AtRiskPopulation.STATE = StateInfo.STATE_NAME
+        LEFT JOIN ObesePopulation ON ObesePopulation.STATE = StateInfo.STATE_NAME
+        LEFT JOIN ICUBeds ON ICUBeds.STATE = StateInfo.STATE_NAME
+        LEFT JOIN HospBeds ON HospBeds.STATE = StateInfo.STATE_NAME
     '''
+    profiles = {}
+    with span('db', 'state profiles'):
+        for row in conn.execute(q):
+            profiles.setdefault(row[0], StateProfile(*row))
+    _STATE_PROFILES.update(profiles)
+    return profiles.get(state)
+
+
+# Each reference table is described by the SQL that creates it (with {table}
+# standing in for the table name so the same SQL can build a staging copy),
+# the INSERT that fills it and the indexes the lookups rely on.
+
+REFERENCE_TABLES = {
+    'AtRiskPopulation': {
+        'create': '''
+            CREATE TABLE {table} (
+                "Id"        INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
+                "STATE" TEXT NOT NULL,
+                "PCT_AT_RISK_POPULATION"  TEXT NOT NULL
+            );
+        ''',
+        'insert': 'INSERT INTO {table} VALUES (NULL, ?, ?)',
+        'indexes': [
+            'CREATE INDEX AtRiskPopulation_STATE ON AtRiskPopulation ("STATE")',
+        ],
+    },
+    'ObesePopulation': {
+        'create': '''
+            CREATE TABLE {table} (
+                "STATE" TEXT NOT NULL,
+                "OBESE_POPULATION"  INT NOT NULL,
+                "PCT MALE" INT NOT NULL,
+                "PCT FEMALE" INT NOT NULL
+            );
+        ''',
+        'insert': 'INSERT INTO {table} VALUES (?, ?, ?, ?)',
+        'indexes': [
+            'CREATE INDEX ObesePopulation_STATE ON ObesePopulation ("STATE")',
+        ],
+    },
+    'ICUBeds': {
+        'create': '''
+            CREATE TABLE {table} (
+                "STATE" TEXT NOT NULL,
+                "ICU_BEDS"  INT NOT NULL,
+                "ICU_BEDS_PER_10K" INT NOT NULL
+            );
+        ''',
+        'insert': 'INSERT INTO {table} VALUES (?, ?, ?)',
+        'indexes': [
+            'CREATE INDEX ICUBeds_STATE ON ICUBeds ("STATE")',
+        ],
+    },
+    'HospBeds': {
+        'create': '''
+            CREATE TABLE {table} (
+                "STATE" TEXT NOT NULL,
+                "TOTAL_BEDS"  INT NOT NULL,
+                "BEDS_PER_1K" INT NOT NULL
+            );
+        ''',
+        'insert': 'INSERT INTO {table} VALUES (?, ?, ?)',
+        'indexes': [
+            'CREATE INDEX HospBeds_STATE ON HospBeds ("STATE")',
+        ],
+    },
+    'StateInfo': {
+        'create': '''
+            CREATE TABLE {table} (
+                "Id" INTEGER PRIMARY KEY AUTOINCREMENT,
+                "FIPS" INTEGER NOT NULL,
+                "STATE_NAME" TEXT NOT NULL,
+                "STATE_ABBRV" TEXT NOT NULL,
+                "NUMERIC_INFO_SITE" TEXT,
+                "INFORMATIONAL_SITE"  TEXT,
+                "TWITTER"  TEXT
+            );
+        ''',
+        'insert': 'INSERT INTO {table} VALUES (NULL, ?, ?, ?, ?, ?, ?)',
+        'indexes': [
+            'CREATE UNIQUE INDEX StateInfo_ABBRV ON StateInfo ("STATE_ABBRV")',
+            'CREATE INDEX StateInfo_NAME ON StateInfo ("STATE_NAME")',
+        ],
+    },
+}
+
+create_meta_sql = '''
+    CREATE TABLE IF NOT EXISTS IngestMeta (
+        "SOURCE" TEXT PRIMARY KEY,
+        "TABLE_NAME" TEXT NOT NULL,
+        "HASH" TEXT NOT NULL,
+        "ROWS" INTEGER NOT NULL,
+        "LOADED_AT" REAL NOT NULL
+    );
+'''
+
 
-    drop_state_sql = '''
-        DROP TABLE IF EXISTS StateInfo;
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_csv_source(csv_file, skip_header):
+    with open(csv_file, 'rb') as file_contents:
+        data = file_contents.read()
+    csv_reader = csv.reader(data.decode('utf-8-sig').splitlines())
+    if skip_header:
+        next(csv_reader)
+    return content_hash(data), list(csv_reader)
+
+
+def read_risk():
+    data_hash, rows = read_csv_source('at_risk_pop.csv', skip_header=False)
+    return data_hash, [
+        [
+            r[0], #state
+            r[1] #pct at risk
+        ]
+        for r in rows]
+
+
+def read_obesity():
+    data_hash, rows = read_csv_source('state_obesity_stats.csv', skip_header=True)
+    return data_hash, [
+        [
+            r[0], #state
+            r[1], #obese population
+            r[2], #male
+            r[3], #female
+        ]
+        for r in rows]
+
+
+def read_icu_beds():
+    data_hash, rows = read_csv_source('icu_beds.csv', skip_header=True)
+    return data_hash, [
+        [
+            r[0], #state
+            r[1], #icu_beds
+            r[2] #icu_beds_per_10k
+        ]
+        for r in rows]
+
+
+def read_hosp_beds():
+    data_hash, rows = read_csv_source('hosp_beds.csv', skip_header=True)
+    return data_hash, [
+        [
+            r[0], #state
+            r[1], #total beds
+            r[2], #beds per 1K
+        ]
+        for r in rows]
+
+
+def read_state():
+    results = get_covid_data("info")
+    data_hash = content_hash(json.dumps(results, sort_keys=True).encode('utf-8'))
+    return data_hash, [
+        [
+            r["fips"], #FIPS
+            r["name"], #STATE
+            r["state"], #STATE ABBRV
+            r["covid19Site"], #NUM INFO SITE
+            r["covid19SiteSecondary"], #INFO SITE
+            r["twitter"] #TWITTER
+        ]
+        for r in results]
+
+
+# source name, table it fills, function returning (content hash, rows)
+INGEST_SOURCES = [
+    ('at_risk_pop.csv', 'AtRiskPopulation', read_risk),
+    ('state_obesity_stats.csv', 'ObesePopulation', read_obesity),
+    ('icu_beds.csv', 'ICUBeds', read_icu_beds),
+    ('hosp_beds.csv', 'HospBeds', read_hosp_beds),
+    ('covidtracking states/info', 'StateInfo', read_state),
+]
+
+
+def ingest(force=False):
+    '''Loads every reference source whose content changed since the last run.
+
+    Each source's content hash is recorded in IngestMeta and unchanged
+    sources are skipped. Changed sources are loaded into a staging table
+    with executemany and swapped in for the live table, all in a single
+    transaction, so the web app never sees a half-loaded table.
+
+    Parameters
+    ----------
+    force: bool
+        reload every source even if its hash is unchanged
+
+    Returns
+    -------
+    list
+        the names of the sources that were loaded
     '''
+    conn = sqlite3.connect(DB_NAME, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(create_meta_sql)
+    known_hashes = dict(conn.execute('SELECT "SOURCE", "HASH" FROM IngestMeta'))
+    existing_tables = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    pending = []
+    for source, table, reader in INGEST_SOURCES:
+        data_hash, rows = reader()
+        if not force and table in existing_tables and known_hashes.get(source) == data_hash:
+            print(f"{source} unchanged, skipping")
+            continue
+        pending.append((source, table, data_hash, rows))
+
+    loaded = []
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        for source, table, data_hash, rows in pending:
+            spec = REFERENCE_TABLES[table]
+            staging = f'{table}_staging'
+            conn.execute(f'DROP TABLE IF EXISTS {staging}')
+            conn.execute(spec['create'].format(table=staging))
+            conn.executemany(spec['insert'].format(table=staging), rows)
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+            conn.execute(f'ALTER TABLE {staging} RENAME TO {table}')
+            for index_sql in spec['indexes']:
+                conn.execute(index_sql)
+            conn.execute('INSERT OR REPLACE INTO IngestMeta VALUES (?, ?, ?, ?, ?)',
+                [source, table, data_hash, len(rows), time.time()])
+            print(f"Loaded {len(rows)} rows from {source} into {table}")
+            loaded.append(source)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return loaded
+
+
+@bp.cli.command('ingest')
+@click.option('--force', is_flag=True, help='Reload sources even if unchanged.')
+def ingest_command(force):
+    '''Load the reference CSVs and state info into the database.'''
+    ingest(force=force)
+
+
+@bp.cli.command('compact-caches')
+def compact_caches_command():
+    '''Drop long-stale entries from the cache files and shrink them.'''
+    for cache in ALL_CACHES:
+        before = os.path.getsize(cache.path) if os.path.exists(cache.path) else 0
+        compact_cache(cache)
+        print(f'Compacted {cache.name} cache: {before // 1024} KB -> '
+            f'{os.path.getsize(cache.path) // 1024} KB')
+
+
+create_daily_covid_sql = '''
+    CREATE TABLE IF NOT EXISTS DailyCovid (
+        "STATE" TEXT NOT NULL,
+        "DATE" INTEGER NOT NULL,
+        "POSITIVE" INTEGER NOT NULL,
+        "HOSPITALIZED_CURRENTLY" INTEGER NOT NULL,
+        "RECOVERED" INTEGER NOT NULL,
+        "DEATHS" INTEGER NOT NULL,
+        "LOADED_AT" REAL NOT NULL,
+        PRIMARY KEY ("STATE", "DATE")
+    ) WITHOUT ROWID;
+'''
+
+# rows are only rewritten (and LOADED_AT bumped) when a count changed, so
+# a state's version only moves when its data does
+upsert_daily_covid_sql = '''
+    INSERT INTO DailyCovid VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT ("STATE", "DATE") DO UPDATE SET
+        "POSITIVE" = excluded."POSITIVE",
+        "HOSPITALIZED_CURRENTLY" = excluded."HOSPITALIZED_CURRENTLY",
+        "RECOVERED" = excluded."RECOVERED",
+        "DEATHS" = excluded."DEATHS",
+        "LOADED_AT" = excluded."LOADED_AT"
+    WHERE "POSITIVE" != excluded."POSITIVE"
+        OR "HOSPITALIZED_CURRENTLY" != excluded."HOSPITALIZED_CURRENTLY"
+        OR "RECOVERED" != excluded."RECOVERED"
+        OR "DEATHS" != excluded."DEATHS"
+'''
+
+DAILY_COVID_BATCH_SIZE = 5000
+
+
+def iter_json_array(file_obj):
+    '''yields the items of a top-level JSON array one at a time
 
-    create_state_sql = '''
-        CREATE TABLE IF NOT EXISTS StateInfo (
-            "Id" INTEGER PRIMARY KEY AUTOINCREMENT,
-            "FIPS" INTEGER NOT NULL,
-            "STATE_NAME" TEXT NOT NULL,
-            "STATE_ABBRV" TEXT NOT NULL,
-            "NUMERIC_INFO_SITE" TEXT,
-            "INFORMATIONAL_SITE"  TEXT,
-            "TWITTER"  TEXT
-        );
+    ijson is used when it is installed so the whole payload never has to be
+    held in memory; otherwise the array is loaded with json.
     '''
+    if ijson is not None:
+        yield from ijson.items(file_obj, 'item', use_float=True)
+    else:
+        yield from json.load(file_obj)
 
-    cur.execute(drop_risk_sql)
-    cur.execute(drop_obese_sql)
-    cur.execute(drop_icu_sql)
-    cur.execute(drop_hosp_sql)
-    cur.execute(drop_state_sql)
 
-    cur.execute(create_risk_sql)
-    cur.execute(create_obese_sql)
-    cur.execute(create_icu_sql)
-    cur.execute(create_hosp_sql)
-    cur.execute(create_state_sql)
+def daily_covid_rows(records, loaded_at):
+    for r in records:
+        yield [
+            r['state'],
+            int(r['date']),
+            int(r.get('positive') or 0),
+            int(r.get('hospitalizedCurrently') or 0),
+            int(r.get('recovered') or 0),
+            int(r.get('death') or 0),
+            loaded_at,
+        ]
 
-    conn.commit()
-    conn.close()
 
+class HashingReader:
+    '''Wraps a binary file object, hashing everything read through it, so
+    a streamed payload's content hash is known once it has been parsed.'''
 
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.digest = hashlib.sha256()
 
-def load_risk():
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.digest.update(data)
+        return data
 
-    file_contents = open('at_risk_pop.csv', 'r')
-    csv_reader = csv.reader(file_contents)
+    def hexdigest(self):
+        return self.digest.hexdigest()
 
-    insert_risk_sql = '''
-        INSERT INTO AtRiskPopulation
-        VALUES (NULL, ?, ?)
-    '''
+    def close(self):
+        self.file_obj.close()
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
 
+DAILY_COVID_SOURCE = 'covidtracking states/daily'
+# COVID_CACHE keeps the all-states download's content hash under this key,
+# with the validators it was served with, for conditional GETs
+DAILY_COVID_REQUEST_KEY = construct_unique_key(COVID_ALL_STATES_URL, {})
 
-    for r in csv_reader:
-        cur.execute(insert_risk_sql,
-            [
-                r[0], #state
-                r[1] #pct at risk
-            ]
-        )
-    conn.commit()
-    conn.close()
 
+def ingest_covid_daily(source_file=None, force=False):
+    '''Upserts the daily history of every state into DailyCovid.
 
-def load_obesity():
+    The history is pulled from the COVID API's all-states endpoint in one
+    request (or replayed from source_file) and parsed as a stream, then
+    written in batches with executemany inside one transaction.
 
-    file_contents = open('state_obesity_stats.csv', 'r')
-    csv_reader = csv.reader(file_contents)
-    next(csv_reader)
+    Like ingest(), the payload's content hash is recorded in IngestMeta and
+    an unchanged payload is not loaded again: a file is hashed before it is
+    parsed, while a download is hashed as it streams in and its transaction
+    rolled back, so DailyCovid (and the versions derived from its LOADED_AT)
+    stay as they were. The download is a conditional GET with the
+    validators of the last one, so an unchanged history is usually not
+    downloaded at all.
 
-    insert_obesity_sql = '''
-        INSERT INTO ObesePopulation
-        VALUES (?, ?, ?, ?)
+    Parameters
+    ----------
+    source_file: string
+        path to a saved copy of the all-states daily JSON, or None to
+        download it
+    force: bool
+        load the payload even if its hash is unchanged
+
+    Returns
+    -------
+    int
+        the number of records loaded, 0 if the payload was unchanged
     '''
+    loaded_at = time.time()
+    conn = sqlite3.connect(DB_NAME, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(create_meta_sql)
+    conn.execute(create_daily_covid_sql)
+    row = conn.execute('SELECT "HASH" FROM IngestMeta WHERE "SOURCE" = ?',
+        [DAILY_COVID_SOURCE]).fetchone()
+    known_hash = None if force or row is None else row[0]
+
+    if source_file is not None:
+        with open(source_file, 'rb') as f:
+            file_hash = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(chunk)
+        data_hash = file_hash.hexdigest()
+        if data_hash == known_hash:
+            conn.close()
+            print(f"{source_file} is unchanged, skipped")
+            return 0
+        file_obj = open(source_file, 'rb')
+        source = source_file
+    else:
+        validators = COVID_CACHE.get_entry(DAILY_COVID_REQUEST_KEY)
+        if validators is not None and validators.value != known_hash:
+            # the table was loaded from somewhere else since
+            validators = None
+        response = fetch(COVID_ALL_STATES_URL, entry=validators, stream=True)
+        if response.status_code == 304 and validators is not None:
+            COVID_CACHE.touch(DAILY_COVID_REQUEST_KEY)
+            conn.close()
+            print(f"{COVID_ALL_STATES_URL} is unchanged, skipped")
+            return 0
+        response.raise_for_status()
+        response.raw.decode_content = True
+        file_obj = HashingReader(response.raw)
+        source = COVID_ALL_STATES_URL
+
+    count = 0
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = daily_covid_rows(iter_json_array(file_obj), loaded_at)
+        while True:
+            batch = list(itertools.islice(rows, DAILY_COVID_BATCH_SIZE))
+            if not batch:
+                break
+            conn.executemany(upsert_daily_covid_sql, batch)
+            count += len(batch)
+        if source_file is None:
+            data_hash = file_obj.hexdigest()
+            COVID_CACHE.set(DAILY_COVID_REQUEST_KEY, data_hash,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'))
+            if data_hash == known_hash:
+                conn.execute('ROLLBACK')
+                print(f"{source} is unchanged, skipped")
+                return 0
+        conn.execute('INSERT OR REPLACE INTO IngestMeta VALUES (?, ?, ?, ?, ?)',
+            [DAILY_COVID_SOURCE, 'DailyCovid', data_hash, count, loaded_at])
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+        file_obj.close()
+    print(f"Loaded {count} daily records from {source} into DailyCovid")
+    return count
+
+
+def warehouse_version(state):
+    '''identifies the version of a state's rows in DailyCovid
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    Returns
+    -------
+    string
+        a version starting with "db:", or None if DailyCovid has no rows
+        for the state (or does not exist yet)
+    '''
+    try:
+        with span('db', 'warehouse version'):
+            count, loaded_at = get_db_connection().execute(
+                'SELECT COUNT(*), MAX("LOADED_AT") FROM DailyCovid WHERE "STATE" = ?',
+                [state]).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    if not count:
+        return None
+    return f'db:{count}:{loaded_at}'
+
+
+def warehouse_in_use():
+    '''whether the bulk ingest has loaded anything into DailyCovid'''
+    try:
+        row = get_db_connection().execute('SELECT 1 FROM DailyCovid LIMIT 1').fetchone()
+    except sqlite3.OperationalError:
+        return False
+    return row is not None
 
 
-    for r in csv_reader:
-        cur.execute(insert_obesity_sql,
-            [
-                r[0], #state
-                r[1], #obese population
-                r[2], #male
-                r[3], #female
-            ]
-        )
-    conn.commit()
-    conn.close()
+def _series_from_rows(rows):
+    if not rows:
+        return StateSeries(*([np.array([], dtype='datetime64[D]')] +
+            [np.array([], dtype=np.int64) for field in SERIES_FIELDS]))
+    table = np.array(rows, dtype=np.int64)
+    return StateSeries(parse_covid_dates(table[:, 0]),
+        *(table[:, i + 1] for i in range(len(SERIES_FIELDS))))
 
 
-def load_icu_beds():
+def read_state_series(state, start=None, end=None):
+    '''Reads a state's series from DailyCovid with an indexed range query.
 
-    file_contents = open('icu_beds.csv', 'r')
-    csv_reader = csv.reader(file_contents)
-    next(csv_reader)
+    Parameters
+    ----------
+    state: string
+        the state's two letter abbreviation
+    start, end: int
+        optional first and last dates (YYYYMMDD) to include
 
-    insert_icu_sql = '''
-        INSERT INTO ICUBeds
-        VALUES (?, ?, ?)
+    Returns
+    -------
+    StateSeries
+    '''
+    q = '''
+        SELECT "DATE", "POSITIVE", "HOSPITALIZED_CURRENTLY", "RECOVERED", "DEATHS"
+        FROM DailyCovid
+        WHERE "STATE" = ? AND "DATE" BETWEEN ? AND ?
+        ORDER BY "DATE"
     '''
+    with span('db', 'state series'):
+        rows = get_db_connection().execute(q,
+            [state, start or 0, end or 99999999]).fetchall()
+    return _series_from_rows(rows)
+
+
+def read_all_state_series():
+    '''reads every state's series from DailyCovid in a single scan'''
+    q = '''
+        SELECT "STATE", "DATE", "POSITIVE", "HOSPITALIZED_CURRENTLY", "RECOVERED", "DEATHS"
+        FROM DailyCovid
+        ORDER BY "STATE", "DATE"
+    '''
+    try:
+        rows = get_db_connection().execute(q).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    series_by_state = {}
+    for state, state_rows in itertools.groupby(rows, key=lambda r: r[0]):
+        series_by_state[state] = _series_from_rows([r[1:] for r in state_rows])
+    return series_by_state
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
 
+@bp.cli.command('ingest-covid')
+@click.option('--file', 'source_file', default=None,
+    help='Load a saved all-states daily JSON file instead of downloading it.')
+@click.option('--force', is_flag=True, help='Reload the history even if unchanged.')
+def ingest_covid_command(source_file, force):
+    '''Load every state's daily COVID history into the database.'''
+    ingest_covid_daily(source_file, force=force)
 
-    for r in csv_reader:
-        cur.execute(insert_icu_sql,
-            [
-                r[0], #state
-                r[1], #icu_beds
-                r[2] #icu_beds_per_10k
-            ]
-        )
-    conn.commit()
-    conn.close()
 
+''' FUNCTIONS FOR FLASK '''
 
-def load_hosp_beds():
 
-    file_contents = open('hosp_beds.csv', 'r')
-    csv_reader = csv.reader(file_contents)
-    next(csv_reader)
+@bp.route('/')
+def index():
+    return render_template('index.html') # just the static HTML
+
+
+# seconds each upstream call in /handle_form may take before the page is
+# rendered without it
+COVID_DEADLINE = 10
+TWEETS_DEADLINE = 5
+COVID_TABLE_DAYS = 30
+# more days than any state's history has; a longer ?days= means all of it
+COVID_MAX_DAYS = 3660
+UPSTREAM_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='upstream')
 
-    insert_hosp_sql = '''
-        INSERT INTO HospBeds
-        VALUES (?, ?, ?)
+
+def submit_upstream(fn, *args):
+    '''runs fn on UPSTREAM_POOL in a copy of the caller's context, so stale
+    sources it meets are reported to the calling request
     '''
+    return UPSTREAM_POOL.submit(contextvars.copy_context().run, fn, *args)
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
 
+def result_by_deadline(future, deadline, default, label):
+    '''waits for future until deadline (a time.monotonic() value)
 
-    for r in csv_reader:
-        cur.execute(insert_hosp_sql,
-            [
-                r[0], #state
-                r[1], #total beds
-                r[2], #beds per 1K
-            ]
-        )
-    conn.commit()
-    conn.close()
+    Parameters
+    ----------
+    future: Future
+        a call submitted to UPSTREAM_POOL
+    deadline: float
+        the time.monotonic() value to give up at
+    default: any
+        what to use instead if the call is late or failed
+    label: string
+        names the call in the log
 
+    Returns
+    -------
+    tuple
+        the call's result (or default) and whether the call succeeded
+    '''
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic())), True
+    except FutureTimeoutError:
+        print(f"{label} missed its deadline")
+    except Exception as e:
+        print(f"{label} failed: {e!r}")
+    return default, False
 
-def load_state():
 
-    results = get_covid_data("info")
+@bp.route('/handle_form', methods=['POST'])
+def handle_the_form():
+    '''sends a submitted form on to the state's page, which can be cached
+    and bookmarked because it is an ordinary GET'''
+    args = {}
+    for field, arg in (('health_status', 'health'), ('cdc_tweets', 'cdc'),
+            ('state_hd_tweets', 'hd')):
+        if field in request.form:
+            args[arg] = 1
+    for field in ('days', 'from', 'to'):
+        if request.form.get(field):
+            args[field] = request.form[field]
+    return redirect(url_for('.state_view', abbr=request.form["states"], **args), code=303)
+
+
+def parse_covid_window(args, default_days=COVID_TABLE_DAYS):
+    '''reads the COVID-19 table's or plot's date window from the from/to
+    or days arguments, using default_days (a number or 'all') without them
 
-    insert_state_sql = '''
-        INSERT INTO StateInfo
-        VALUES (NULL, ?, ?, ?, ?, ?, ?)
+    Returns
+    -------
+    tuple
+        (start, end, days): a from/to range as datetime64[D] (either end
+        may be None), or how many days back from the newest date to show;
+        all None for the full history
     '''
+    start = parse_date_arg('from', args)
+    end = parse_date_arg('to', args)
+    days = args.get('days', str(default_days))
+    if start is not None or end is not None or days == 'all':
+        return start, end, None
+    if not days.isdecimal() or int(days) < 1:
+        abort(400, 'days must be a positive number or "all"')
+    if int(days) > COVID_MAX_DAYS:
+        return None, None, None
+    return None, None, int(days)
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
 
-    for r in results:
-        cur.execute(insert_state_sql,
-            [
-                r["fips"], #FIPS
-                r["name"], #STATE
-                r["state"], #STATE ABBRV
-                r["covid19Site"], #NUM INFO SITE
-                r["covid19SiteSecondary"], #INFO SITE
-                r["twitter"] #TWITTER
-            ]
-        )
-    conn.commit()
-    conn.close()
+PAGE_CACHE_MAX_ENTRIES = 200
+FRAGMENT_CACHE_MAX_ENTRIES = 1000
 
 
+class RenderCache:
+    '''A thread-safe, bounded LRU of rendered HTML.
 
-''' FUNCTIONS FOR FLASK '''
+    Keys include the versions of the data the HTML was rendered from, so
+    when a source changes its old entries stop matching and age out.
+    '''
 
-create_db()
-load_risk()
-load_obesity()
-load_icu_beds()
-load_hosp_beds()
-load_state()
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return html
 
+    def set(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
 
-def get_db_info(info, state):
-    conn = sqlite3.connect("covid_state_info.sqlite")
-    cur = conn.cursor()
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
 
-    select_statement = f'SELECT "{info}"'
-    where_clause = f'WHERE STATE_ABBRV = "{state}"'
 
-    q = f'''
-        {select_statement}
-        FROM AtRiskPopulation
-        JOIN StateInfo ON AtRiskPopulation.STATE = StateInfo.STATE_NAME
-        {where_clause}
-    '''
-    results = cur.execute(q).fetchall()
-    conn.close()
-    return results[0]
+PAGE_CACHE = RenderCache(PAGE_CACHE_MAX_ENTRIES)
+FRAGMENT_CACHE = RenderCache(FRAGMENT_CACHE_MAX_ENTRIES)
 
 
-def addl_db_info(info, state, table):
-    conn = sqlite3.connect("covid_state_info.sqlite")
-    cur = conn.cursor()
+def fresh_version(cache, request_key):
+    '''the version of a cache entry, or None if it is missing or due for
+    a refresh'''
+    stamp = cache.peek(request_key)
+    if stamp is None or not stamp.fresh:
+        return None
+    return stamp.version
 
-    select_statement = f'SELECT {info}'
-    where_clause = f'WHERE STATE_ABBRV = "{state}"'
 
-    q = f'''
-        {select_statement}
-        FROM {table}
-        JOIN StateInfo ON {table}.STATE = StateInfo.STATE_NAME
-        {where_clause}
-    '''
-    results = cur.execute(q).fetchall()
-    conn.close()
-    return results[0]
+def fresh_covid_version(state):
+    return warehouse_version(state) or fresh_version(COVID_CACHE,
+        construct_unique_key(COVID_BASE_URL+"daily", {'state': state}))
 
 
-@app.route('/')
-def index():
-    return render_template('index.html') # just the static HTML
+def render_fragment(template_name, key, **context):
+    '''renders a partial template, keeping it in FRAGMENT_CACHE under key
+    unless key is None'''
+    with span('template', template_name):
+        html = render_template(template_name, **context)
+    if key is not None:
+        FRAGMENT_CACHE.set(key, html)
+    return html
 
 
-@app.route('/handle_form', methods=['POST'])
-def handle_the_form():
-    selected_state = request.form["states"]
-    state_name = get_db_info("STATE_NAME", selected_state)[0]
-    state_info = get_covid_state_data(selected_state)[selected_state]
-    want_health_status = "health_status" in request.form.keys()
-    want_cdc_tweets = "cdc_tweets" in request.form.keys()
-    want_state_hd_tweets = "state_hd_tweets" in request.form.keys()
-    graph_string=f'/covid_plot/{selected_state}'
-    state_pct_at_risk = get_db_info("PCT_AT_RISK_POPULATION", selected_state)[0]
-    state_obese_pop = addl_db_info("OBESE_POPULATION", selected_state, "ObesePopulation")[0]
-    state_obese_pop = round(state_obese_pop*100,1)
-    state_obese_pop = f'{state_obese_pop}%'
-    state_icu_beds = addl_db_info("ICU_BEDS", selected_state, "ICUBeds")[0]
-    state_hosp_beds = addl_db_info("TOTAL_BEDS", selected_state, "HospBeds")[0]
-    cdc_tweets = find_tweets(TWITTER_BASEURL, "from:@CDCgov", 5)
-    state_hd_twitter_acct = get_db_info("TWITTER", selected_state)[0]
-    from_acct = f'from:{state_hd_twitter_acct}'
-    state_tweets = find_tweets(TWITTER_BASEURL, from_acct, 5)
-    return render_template('response.html',
-        states=selected_state,
-        state_name=state_name,
-        want_health_status=want_health_status,
-        pct_at_risk_stat = state_pct_at_risk,
-        state_obese_pop=state_obese_pop,
-        state_icu_beds=state_icu_beds,
-        state_hosp_beds=state_hosp_beds,
-        want_cdc_tweets=want_cdc_tweets,
-        cdc_tweets = cdc_tweets,
-        want_state_hd_tweets=want_state_hd_tweets,
-        state_tweets = state_tweets,
-        state_info=state_info,
-        graph_link=graph_string
-        )
+@bp.route('/state/<abbr>')
+def state_view(abbr):
+    '''the COVID-19 page for a state
 
+    health=1, cdc=1 and hd=1 add the health status table, CDC Tweets and
+    the state health department's Tweets; from/to or days pick the dates
+    in the COVID-19 table (the last COVID_TABLE_DAYS by default).
 
-@app.route('/articles')
-def get_headlines():
-    params = {
+    Whole pages, and their Tweet, health status and COVID-19 table
+    fragments, are kept rendered under the request and the versions of the
+    data behind them, so a repeat view is a dictionary lookup. Nothing that
+    was stale or unavailable is kept.
+    '''
+    profile = state_profile_or_404(abbr)
+    state = profile.abbrv
+    want_health_status = request.args.get('health') == '1'
+    want_cdc_tweets = request.args.get('cdc') == '1'
+    want_state_hd_tweets = request.args.get('hd') == '1'
+    start, end, days = parse_covid_window(request.args)
+    full_history = start is None and end is None and days is None
+
+    # (label, account) for each Tweet section asked for
+    tweet_sections = []
+    if want_cdc_tweets:
+        tweet_sections.append(("CDC Tweets", CDC_ACCOUNT))
+    if want_state_hd_tweets:
+        tweet_sections.append((f"{profile.name} Health Department Tweets",
+            f'from:{profile.twitter}'))
+
+    def page_key():
+        versions = [fresh_covid_version(state), reference_data_version()]
+        versions += [fresh_version(TWITTER_CACHE_DICT, tweets_request_key(account))
+            for label, account in tweet_sections]
+        if None in versions:
+            return None
+        return (state, want_health_status, want_cdc_tweets, want_state_hd_tweets,
+            str(start), str(end), days, tuple(versions))
+
+    key = page_key()
+    if key is not None:
+        html = PAGE_CACHE.get(key)
+        if html is not None:
+            return html
+
+    stale = track_staleness()
+    started = time.monotonic()
+    reference_version = reference_data_version()
+
+    covid_version = fresh_covid_version(state)
+    covid_table_html = None
+    if covid_version is not None and not full_history:
+        covid_table_html = FRAGMENT_CACHE.get(('covid', state, str(start), str(end),
+            days, covid_version, reference_version))
+    if covid_table_html is None:
+        covid_future = submit_upstream(get_state_series, state)
+
+    tweets_html = {}
+    tweet_futures = {}
+    for label, account in tweet_sections:
+        version = fresh_version(TWITTER_CACHE_DICT, tweets_request_key(account))
+        if version is not None:
+            tweets_html[label] = FRAGMENT_CACHE.get(('tweets', account, label, version))
+        if tweets_html.get(label) is None:
+            tweet_futures[label] = submit_upstream(find_tweets, TWITTER_BASEURL,
+                account, TWEETS_PER_ACCOUNT)
+
+    health_html = None
+    if want_health_status:
+        health_key = ('health', state, reference_version)
+        health_html = FRAGMENT_CACHE.get(health_key) or render_fragment(
+            '_health_status.html', health_key,
+            state_name=profile.name,
+            pct_at_risk_stat=profile.pct_at_risk,
+            state_obese_pop=profile.obese_pct,
+            state_icu_beds=profile.icu_beds,
+            state_hosp_beds=profile.hosp_beds)
+
+    unavailable = []
+    covid_context = {}
+    if covid_table_html is None:
+        series, ok = result_by_deadline(covid_future, started + COVID_DEADLINE,
+            None, "COVID data")
+        window_start = start
+        if ok:
+            if days is not None and len(series.dates):
+                window_start = series.dates[-1] - np.timedelta64(days - 1, 'D')
+            covid_rows = covid_table_rows(series, window_start, end)
+        else:
+            unavailable.append("COVID-19 stats")
+            covid_rows = iter(())
+        if days is not None:
+            covid_window = f'last {days} days'
+        elif full_history:
+            covid_window = 'full history'
+        else:
+            covid_window = ' to '.join('...' if d is None else str(d) for d in (start, end))
+        covid_context = dict(
+            state_name=profile.name,
+            covid_rows=covid_rows,
+            covid_window=covid_window,
+            metrics=latest_state_metrics(state) if ok else None)
+        if not full_history:
+            covid_version = fresh_covid_version(state)
+            cacheable = ok and COVID_CACHE.name not in stale and covid_version is not None
+            covid_table_html = render_fragment('_covid_table.html',
+                ('covid', state, str(start), str(end), days, covid_version,
+                    reference_version) if cacheable else None,
+                **covid_context)
+
+    for label, account in tweet_sections:
+        if label not in tweet_futures:
+            continue
+        tweets, ok = result_by_deadline(tweet_futures[label],
+            started + TWEETS_DEADLINE, [], label)
+        if not ok:
+            unavailable.append(label)
+        version = fresh_version(TWITTER_CACHE_DICT, tweets_request_key(account))
+        cacheable = ok and TWITTER_CACHE_DICT.name not in stale and version is not None
+        tweets_html[label] = render_fragment('_tweets.html',
+            ('tweets', account, label, version) if cacheable else None,
+            title=label, tweets=tweets)
+
+    context = dict(covid_context,
+        state_name=profile.name,
+        tweets_html=[tweets_html[label] for label, account in tweet_sections],
+        health_html=health_html,
+        covid_table_html=covid_table_html,
+        graph_link=url_for('.plot', state=state),
+        unavailable=unavailable,
+        stale=sorted(stale))
+    key = page_key() if not unavailable and not stale else None
+    if not full_history:
+        with span('template', 'response.html'):
+            html = render_template('response.html', **context)
+        if key is not None:
+            PAGE_CACHE.set(key, html)
+        return html
+    # the full history runs to hundreds of rows: send the page as the
+    # template produces it rather than building the whole table first
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template('response.html')
+    return Response(stream_with_context(stream_into_page_cache(
+        template.generate(context), key)), mimetype='text/html')
+
+
+def stream_into_page_cache(chunks, key):
+    '''passes chunks through, keeping the whole page in PAGE_CACHE under
+    key once the last one has been sent (unless key is None)'''
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk)
+        yield chunk
+    if key is not None:
+        PAGE_CACHE.set(key, ''.join(sent))
+
+
+ARTICLES_PER_PAGE = 10
+MAX_ARTICLES_PER_PAGE = 50
+
+
+def get_news_articles():
+    '''returns the current COVID-19 headlines from NewsAPI, cached in
+    NEWS_CACHE_DICT (the API key is left out of the cache key)
+
+    Concurrent misses share a single upstream call (see fetch_using_cache).
+    '''
+    query = {
         "country": "us",
-        "apiKey": secrets.NEWSAPI_KEY,
         "q": "COVID-19"
     }
+    params = dict(query, apiKey=get_secret('NEWSAPI_KEY'))
+    request_key = construct_unique_key(NEWS_API_BASE_URL, query)
+    results = fetch_using_cache(NEWS_API_BASE_URL, params, NEWS_CACHE_DICT, request_key)
+    return parse_json_once(NEWS_CACHE_DICT, request_key, results)['articles']
+
+
+def paginate(items, page, per_page):
+    '''Picks one page out of a list.
+
+    Parameters
+    ----------
+    items: list
+        everything there is to show
+    page: int
+        the 1-based page wanted; clamped to the pages that exist
+    per_page: int
+        items on each page; clamped to 1..MAX_ARTICLES_PER_PAGE
+
+    Returns
+    -------
+    tuple
+        the items on the page and a dict describing the page
+    '''
+    per_page = min(max(per_page, 1), MAX_ARTICLES_PER_PAGE)
+    pages = max(1, -(-len(items) // per_page))
+    page = min(max(page, 1), pages)
+    start = (page - 1) * per_page
+    return items[start:start + per_page], {
+        'page': page,
+        'per_page': per_page,
+        'pages': pages,
+        'total': len(items),
+    }
+
+
+def requested_page():
+    return (request.args.get('page', 1, type=int),
+        request.args.get('per_page', ARTICLES_PER_PAGE, type=int))
+
+
+@bp.route('/articles')
+def get_headlines():
+    stale = track_staleness()
     article_info_list = []
-    response = requests.get(NEWS_API_BASE_URL, params)
-    result = response.json()
-    articles = result['articles']
+    articles, page_info = paginate(get_news_articles(), *requested_page())
     for a in articles:
         headline = a['title']
         author = a['author']
@@ -716,100 +2914,685 @@ def get_headlines():
         article_info_list.append(article_info)
     return render_template('articles.html',
         articles=article_info_list,
+        page_info=page_info,
+        stale=sorted(stale),
         )
 
 
-@app.route('/covid_plot/<state>')
+@bp.route('/api/articles')
+def get_headlines_json():
+    stale = track_staleness()
+    articles, page_info = paginate(get_news_articles(), *requested_page())
+    return jsonify(
+        articles=[{'title': a['title'], 'author': a['author'], 'url': a['url']}
+                  for a in articles],
+        stale=bool(stale),
+        **page_info)
+
+
+# points per plotted series: the default, and the range ?points= is held to
+PLOT_POINTS = 300
+PLOT_MIN_POINTS = 20
+PLOT_MAX_POINTS = 2000
+FIGURE_CACHE_MAX_ENTRIES = 200
+
+
+def minmax_indices(values, points):
+    '''picks about points indices of values to plot, in order
+
+    The values are split into buckets and each bucket's lowest and highest
+    values are kept, along with the first and last, so peaks and dips
+    survive however long the series is.
+
+    Parameters
+    ----------
+    values: numpy array
+        the series, oldest first
+    points: int
+        how many points to keep at most
+
+    Returns
+    -------
+    numpy array
+        the sorted indices to keep; all of them if there are few enough
+    '''
+    n = len(values)
+    if n <= points:
+        return np.arange(n)
+    buckets = max((points - 2) // 2, 1)
+    edges = np.linspace(1, n - 1, buckets + 1).astype(np.int64)
+    keep = [0, n - 1]
+    for lo, hi in zip(edges[:-1].tolist(), edges[1:].tolist()):
+        if hi > lo:
+            bucket = values[lo:hi]
+            keep += [lo + int(bucket.argmin()), lo + int(bucket.argmax())]
+    return np.unique(keep)
+
+
+def build_covid_figure(state, start=None, end=None, points=PLOT_POINTS):
+    '''Builds a single figure with the four COVID series as subplots.
+
+    Parameters
+    ----------
+    state: string
+        the state's two letter abbreviation
+    start, end: numpy datetime64[D]
+        the first and last dates to plot (None leaves that side open)
+    points: int
+        how many points each series is downsampled to at most
+
+    Returns
+    -------
+    string
+        the figure as Plotly JSON
+    '''
+    series = get_state_series(state)
+    lo, hi = series_window(series, start, end)
+    dates = series.dates[lo:hi]
+    titles = ['Positive Cases', 'Currently Hospitalized', 'Recovered', 'Deaths']
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    fig = make_subplots(rows=2, cols=2, subplot_titles=titles)
+    columns = [series.positive, series.hospitalized, series.recovered, series.deaths]
+    for i, (title, y_vals) in enumerate(zip(titles, columns)):
+        y_vals = y_vals[lo:hi]
+        keep = minmax_indices(y_vals, points)
+        fig.add_trace(go.Scatter(x=dates[keep], y=y_vals[keep], mode='lines', name=title),
+            row=i // 2 + 1, col=i % 2 + 1)
+    fig.update_layout(height=800, showlegend=False)
+    return fig.to_json()
+
+
+# (state, window, points, COVID data version) -> figure JSON
+_FIGURE_CACHE = RenderCache(FIGURE_CACHE_MAX_ENTRIES)
+
+
+def get_covid_figure(state, start=None, end=None, days=None, points=PLOT_POINTS):
+    '''returns the figure JSON for a state's dates between start and end,
+    or its last days days, rebuilding it only when the state's COVID series
+    has changed since it was last built
+    '''
+    series = get_state_series(state)
+    version = covid_data_version(state)
+    key = (state, str(start), str(end), days, points, version)
+    figure_json = _FIGURE_CACHE.get(key)
+    if figure_json is not None:
+        return figure_json
+    if days is not None and len(series.dates):
+        start = series.dates[-1] - np.timedelta64(days - 1, 'D')
+    with span('plot', state):
+        figure_json = build_covid_figure(state, start, end, points)
+    _FIGURE_CACHE.set(key, figure_json)
+    return figure_json
+
+
+def parse_plot_points(args):
+    '''reads how many points to plot per series from the points argument,
+    held between PLOT_MIN_POINTS and PLOT_MAX_POINTS'''
+    points = args.get('points', str(PLOT_POINTS))
+    if not points.isdecimal():
+        abort(400, 'points must be a positive number')
+    return min(max(int(points), PLOT_MIN_POINTS), PLOT_MAX_POINTS)
+
+
+@functools.lru_cache(maxsize=None)
+def plotly_version():
+    '''the installed Plotly version, read without importing Plotly'''
+    return importlib.metadata.version('plotly')
+
+
+@bp.route('/plotly.js')
+def plotly_js():
+    '''serves the plotly.js bundle once so plot pages don't embed it'''
+    from plotly.offline import get_plotlyjs
+    response = current_app.response_class(get_plotlyjs(), mimetype='application/javascript')
+    response.set_etag(f'plotly-{plotly_version()}')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * DAY
+    return response.make_conditional(request)
+
+
+@bp.route('/covid_plot/<state>')
 def plot(state):
-    date_list = []
-    pos_cases_list = []
-    cur_hosp_list = []
-    recov_list = []
-    deaths_list = []
-    state_info = get_covid_state_data(state)
-    state_name = get_db_info("STATE_NAME", state)[0]
-    state_pct_at_risk = get_db_info("PCT_AT_RISK_POPULATION", state)[0]
-    state_obese_pop = addl_db_info("OBESE_POPULATION", state, "ObesePopulation")[0]
-    state_obese_pop = round(state_obese_pop*100,1)
-    state_obese_pop = f'{state_obese_pop}%'
-    state_icu_beds = addl_db_info("ICU_BEDS", state, "ICUBeds")[0]
-    state_hosp_beds = addl_db_info("TOTAL_BEDS", state, "HospBeds")[0]
-    for key, values in state_info[state].items():
-        date_str = str(key)
-        date = datetime(year=int(date_str[0:4]), month=int(date_str[4:6]), day=int(date_str[6:8]))
-        date_list.append(date)
-        for key, value in values.items():
-            if key == 'positive cases':
-                pos_cases_list.append(value)
-            if key == 'currently hospitalized':
-                cur_hosp_list.append(value)
-                cur_hosp_list = [0 if i is None else i for i in cur_hosp_list]
-            if key == 'recovered':
-                recov_list.append(value)
-            if key == 'deaths':
-                deaths_list.append(value)
-
-    x_vals = date_list
-    y_vals = pos_cases_list
-
-    line_data_one = go.Line(
-        x=x_vals,
-        y=y_vals
-    )
-
-    x_vals = date_list
-    y_vals = cur_hosp_list
-
-    line_data_two = go.Line(
-        x=x_vals,
-        y=y_vals
-    )
-
-    x_vals = date_list
-    y_vals = recov_list
-
-    line_data_three = go.Line(
-        x=x_vals,
-        y=y_vals
-    )
-
-    x_vals = date_list
-    y_vals = deaths_list
-
-    line_data_four = go.Line(
-        x=x_vals,
-        y=y_vals
-    )
-
-    basic_layout = go.Layout(title='Positive Cases')
-    fig_one = go.Figure(data=line_data_one, layout=basic_layout)
-    div_one = fig_one.to_html(full_html=False)
-
-    basic_layout = go.Layout(title='Currently Hospitalized')
-    fig_two = go.Figure(data=line_data_two, layout=basic_layout)
-    div_two = fig_two.to_html(full_html=False)
-
-    basic_layout = go.Layout(title='Recovered')
-    fig_three = go.Figure(data=line_data_three, layout=basic_layout)
-    div_three = fig_three.to_html(full_html=False)
-
-    basic_layout = go.Layout(title='Deaths')
-    fig_four = go.Figure(data=line_data_four)
-    div_four = fig_four.to_html(full_html=False)
-
-    return render_template("covid_plot.html",
-        state_name=state_name,
-        pct_at_risk_stat = state_pct_at_risk,
-        state_obese_pop = state_obese_pop,
-        state_icu_beds = state_icu_beds,
-        state_hosp_beds = state_hosp_beds,
-        plot_div1=div_one,
-        plot_div2=div_two,
-        plot_div3=div_three,
-        plot_div4=div_four)
+    stale = track_staleness()
+    profile = state_profile_or_404(state)
+    state = profile.abbrv
+    start, end, days = parse_covid_window(request.args, default_days='all')
+    points = parse_plot_points(request.args)
+    unavailable = []
+    try:
+        figure_json = get_covid_figure(state, start, end, days, points)
+    except requests.RequestException as e:
+        print(f"COVID data for {state} failed: {e!r}")
+        unavailable.append("COVID-19 stats")
+        figure_json = None
+
+    with span('template', 'covid_plot.html'):
+        return render_template("covid_plot.html",
+            state_name=profile.name,
+            pct_at_risk_stat = profile.pct_at_risk,
+            state_obese_pop = profile.obese_pct,
+            state_icu_beds = profile.icu_beds,
+            state_hosp_beds = profile.hosp_beds,
+            plotly_version=plotly_version(),
+            figure_json=figure_json,
+            plot_days=request.args.get('days', 'all'),
+            plot_from=request.args.get('from', ''),
+            plot_to=request.args.get('to', ''),
+            plot_points=points,
+            unavailable=unavailable,
+            stale=sorted(stale))
+
+
+''' JSON API '''
+
+API_PROFILE_MAX_AGE = DAY
+API_SERIES_MAX_AGE = 10 * MINUTE
+API_TWEETS_MAX_AGE = MINUTE
+# the forms ?from= and ?to= dates are accepted in
+DATE_ARG_FORMATS = ('%Y-%m-%d', '%Y%m%d')
+# seconds clients are asked to wait after a 503
+API_RETRY_AFTER = MINUTE
+COMPRESS_MIN_SIZE = 500
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'text/html'}
+
+
+def reference_data_version():
+    '''identifies the version of the reference tables from the content
+    hashes the ingest command recorded
+    '''
+    row = get_db_connection().execute(
+        'SELECT group_concat("HASH", \',\') FROM IngestMeta WHERE "TABLE_NAME" != \'DailyCovid\'').fetchone()
+    return row[0]
+
+
+def cache_entry_version(cache, request_key):
+    stamp = cache.peek(request_key)
+    if stamp is None:
+        return None
+    return stamp.version
+
+
+def unavailable_json(**payload):
+    '''answers 503 with payload, for when the upstream failed and nothing
+    was cached to fall back on, as the state page leaves that part out'''
+    response = jsonify(**payload)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(API_RETRY_AFTER)
+    return response
+
+
+def conditional_json(version, max_age, build_payload):
+    '''Answers a GET with JSON that can be cached by browsers and CDNs.
+
+    The ETag is derived from the request URL and the version of the data
+    behind it, so it can be compared before the payload is built; a
+    matching If-None-Match gets an empty 304.
+
+    Parameters
+    ----------
+    version: string
+        the version of the data the response is built from
+    max_age: int
+        seconds clients may reuse the response without asking again
+    build_payload: function
+        returns the dict to send
+
+    Returns
+    -------
+    Response
+    '''
+    etag = hashlib.sha1(
+        f'{request.full_path}|{version}'.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
+
+
+def state_profile_or_404(abbr):
+    profile = get_state_profile(abbr.upper())
+    if profile is None:
+        abort(404)
+    return profile
+
+
+def parse_date_arg(name, args=None):
+    '''reads a YYYY-MM-DD or YYYYMMDD query argument (or form field, when
+    args is request.form) as datetime64[D]'''
+    value = (request.args if args is None else args).get(name)
+    if not value:
+        return None
+    for date_format in DATE_ARG_FORMATS:
+        try:
+            date = datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+        # strptime also takes unpadded months and days, e.g. 2020-4-1
+        if date.strftime(date_format) == value:
+            return np.datetime64(date, 'D')
+    abort(400, f'{name} must be a date like 2020-04-20')
+
+
+@bp.route('/api/states/<abbr>/profile')
+def api_state_profile(abbr):
+    profile = state_profile_or_404(abbr)
+    return conditional_json(reference_data_version(), API_PROFILE_MAX_AGE,
+        lambda: dict(profile._asdict(), obese_pct=profile.obese_pct))
+
+
+@bp.route('/api/states/<abbr>/series')
+def api_state_series(abbr):
+    profile = state_profile_or_404(abbr)
+    start = parse_date_arg('from')
+    end = parse_date_arg('to')
+    all_fields = [field for field, api_field in SERIES_FIELDS]
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else all_fields
+    unknown = set(fields) - set(all_fields)
+    if unknown:
+        abort(400, f'unknown fields: {", ".join(sorted(unknown))}')
+
+    try:
+        series = get_state_series(profile.abbrv)
+    except requests.RequestException as e:
+        print(f"COVID-19 stats for {profile.abbrv} failed: {e!r}")
+        return unavailable_json(state=profile.abbrv, stale=True,
+            dates=[], **{field: [] for field in fields})
+
+    def build_payload():
+        lo, hi = series_window(series, start, end)
+        payload = {
+            'state': profile.abbrv,
+            'dates': np.datetime_as_string(series.dates[lo:hi]).tolist(),
+        }
+        for field in fields:
+            payload[field] = getattr(series, field)[lo:hi].tolist()
+        return payload
+
+    return conditional_json(covid_data_version(profile.abbrv), API_SERIES_MAX_AGE,
+        build_payload)
+
+
+@bp.route('/api/states/<abbr>/tweets')
+def api_state_tweets(abbr):
+    profile = state_profile_or_404(abbr)
+    account = f'from:{profile.twitter}'
+    try:
+        tweets = find_tweets(TWITTER_BASEURL, account, TWEETS_PER_ACCOUNT)
+    except requests.RequestException as e:
+        print(f"Tweets for {profile.abbrv} failed: {e!r}")
+        return unavailable_json(state=profile.abbrv,
+            account=profile.twitter, tweets=[], stale=True)
+    return conditional_json(cache_entry_version(TWITTER_CACHE_DICT, tweets_request_key(account)),
+        API_TWEETS_MAX_AGE, lambda: {'state': profile.abbrv,
+            'account': profile.twitter, 'tweets': tweets})
+
+
+# (ETag, encoding) -> compressed body, for responses that are sent often
+_COMPRESSED_BODIES = OrderedDict()
+_COMPRESSED_BODIES_MAX = 64
+_COMPRESSED_BODIES_LOCK = threading.Lock()
+
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+@bp.after_app_request
+def compress_response(response):
+    '''gzip or brotli compresses text responses for clients that accept it
+
+    Bodies of responses with an ETag (API answers, plotly.js) are kept
+    compressed so repeat requests don't pay for compression again.
+    '''
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code != 200
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding = 'br'
+    elif accepted['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    etag = response.headers.get('ETag')
+    if etag is None:
+        body = compress_body(data, encoding)
+    else:
+        with _COMPRESSED_BODIES_LOCK:
+            body = _COMPRESSED_BODIES.get((etag, encoding))
+            if body is not None:
+                _COMPRESSED_BODIES.move_to_end((etag, encoding))
+        if body is None:
+            body = compress_body(data, encoding)
+            with _COMPRESSED_BODIES_LOCK:
+                _COMPRESSED_BODIES[(etag, encoding)] = body
+                while len(_COMPRESSED_BODIES) > _COMPRESSED_BODIES_MAX:
+                    _COMPRESSED_BODIES.popitem(last=False)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# seconds between background refreshes of each source
+REFRESH_SCHEDULE = {
+    'COVID-19 stats': 30 * MINUTE,
+    'state info': DAY,
+    'KFF pages': DAY,
+    'Tweets': 10 * MINUTE,
+    'headlines': 20 * MINUTE,
+    'cache files': DAY,
+}
+# entry each cache file keeps to note when it was last compacted
+COMPACTED_KEY = 'compacted'
+
+
+def refresh_once(cache, request_key, max_age, fn, *args):
+    '''runs fn(*args) to refresh request_key, unless it was stored less
+    than max_age seconds ago (another process sharing the cache file has
+    already refreshed it) or another process holds the lease on it
+    '''
+    stamp = cache.peek(request_key)
+    if stamp is not None and time.time() - stamp.stored_at < max_age:
+        return
+    if not cache.acquire_lease(request_key):
+        return
+    try:
+        fn(*args)
+    finally:
+        cache.release_lease(request_key)
+
+
+def refresh_watched(cache, max_age=0):
+    '''revalidates the entries of cache that have been requested since
+    startup and not refreshed in the last max_age seconds
+    '''
+    for request_key, (url, params, auth, extract) in list(WATCHED[cache.name].items()):
+        refresh_once(cache, request_key, max_age, cache.flight.do, request_key,
+            revalidate, url, params, cache, request_key, auth, extract)
+
+
+def compact_cache(cache):
+    cache.compact()
+    cache.set(COMPACTED_KEY, time.time())
+
+
+def compact_caches(max_age=0):
+    '''compacts every cache file not compacted in the last max_age seconds
+    (by this or another process)
+    '''
+    for cache in ALL_CACHES:
+        refresh_once(cache, COMPACTED_KEY, max_age, compact_cache, cache)
+
+
+def refresh_covid():
+    '''reloads the all-states history if the warehouse is in use, then
+    the per-state series that have been requested, then the metrics
+    '''
+    max_age = REFRESH_SCHEDULE['COVID-19 stats'] / 2
+    if warehouse_in_use():
+        refresh_once(COVID_CACHE, DAILY_COVID_REQUEST_KEY, max_age, ingest_covid_daily)
+    refresh_watched(COVID_CACHE, max_age)
+    refresh_all_state_metrics()
+
+
+def start_background_refresh():
+    '''registers a refresh job for each source and starts the scheduler
+
+    Every process running the scheduler has the same jobs, so an entry
+    refreshed within the last half interval, i.e. by another process, is
+    skipped rather than fetched again.
+    '''
+    SCHEDULER.add_job('COVID-19 stats', REFRESH_SCHEDULE['COVID-19 stats'], refresh_covid)
+    for cache in [STATE_COV_CACHE, URL_CACHE, TWITTER_CACHE_DICT, NEWS_CACHE_DICT]:
+        interval = REFRESH_SCHEDULE[cache.name]
+        SCHEDULER.add_job(cache.name, interval,
+            functools.partial(refresh_watched, cache, interval / 2))
+    SCHEDULER.add_job('cache files', REFRESH_SCHEDULE['cache files'],
+        functools.partial(compact_caches, REFRESH_SCHEDULE['cache files'] / 2))
+    SCHEDULER.start()
+
+
+_START_REFRESH_LOCK = threading.Lock()
+
+
+def ensure_background_refresh():
+    '''starts the background refresh in this process unless it is already
+    running
+
+    Registered as a before_request hook by create_app() when
+    BACKGROUND_REFRESH is set, so it starts in the process that serves
+    requests: each gunicorn worker after the fork, or the reloader's child.
+    '''
+    if SCHEDULER.running:
+        return
+    with _START_REFRESH_LOCK:
+        if not SCHEDULER.running:
+            start_background_refresh()
+
+
+ADMIN_ADDRESSES = {'127.0.0.1', '::1'}
+
+
+def is_admin_request():
+    '''whether the request may see the admin pages and timing details:
+    it carries the ADMIN_TOKEN (app config, secrets.py or environment) as
+    a bearer token, or, with no token set, it is a local request to the
+    debug server
+
+    The client address alone isn't enough, since behind a reverse proxy
+    on the same machine every request comes from 127.0.0.1.
+    '''
+    token = current_app.config.get('ADMIN_TOKEN') or get_secret('ADMIN_TOKEN')
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''),
+            f'Bearer {token}')
+    return current_app.debug and request.remote_addr in ADMIN_ADDRESSES
+
+
+@bp.route('/admin/refresh')
+def refresh_status():
+    '''shows the background refresh status (only to admin requests)'''
+    if not is_admin_request():
+        abort(403)
+    return jsonify(scheduler=SCHEDULER.status(), rate_limits=rate_limit_stats())
+
+
+@bp.route('/admin/cache')
+def cache_status():
+    '''shows hit, miss and coalesced counters for each cache (only to
+    admin requests)
+    '''
+    if not is_admin_request():
+        abort(403)
+    return jsonify({cache.name: cache.stats() for cache in ALL_CACHES})
+
+
+def reset_caches():
+    '''empties every cache store and in-process memo, so the next request
+    starts cold (used by benchmark.py)'''
+    for cache in ALL_CACHES:
+        cache.clear()
+    for memo in (_PARSED_JSON, _SERIES_CACHE, STATE_METRICS, _STATE_PROFILES,
+            _FIGURE_CACHE, _COMPRESSED_BODIES, PAGE_CACHE, FRAGMENT_CACHE):
+        memo.clear()
+
+
+''' TRACING, METRICS AND PROFILING '''
+
+# seconds between stack samples when a request is profiled with ?profile=1
+PROFILE_INTERVAL = 0.005
+
+
+class SamplingProfiler:
+    '''Samples the stack of one request's thread, and of the upstream pool
+    threads working for it, until stopped.
+
+    Samples are counted as collapsed stacks ("outer;...;inner count"), the
+    input format of flamegraph.pl and speedscope.
+    '''
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, '')
+                if ident != self.thread_id and not name.startswith('upstream'):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}'
+                        f':{code.co_firstlineno})')
+                    frame = frame.f_back
+                if ident != self.thread_id and any(f.startswith('get (queue.py') for f in stack):
+                    continue  # an idle pool thread waiting for work
+                stack.append(name)
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return '\n'.join(f'{stack} {count}'
+            for stack, count in sorted(self.samples.items())) + '\n'
+
+
+@bp.before_app_request
+def start_request_trace():
+    g.trace = start_trace()
+    g.started = time.perf_counter()
+    g.profiler = None
+    if current_app.debug and request.args.get('profile') == '1':
+        g.profiler = SamplingProfiler(threading.get_ident())
+        g.profiler.start()
+
+
+@bp.after_app_request
+def finish_request_trace(response):
+    '''records the request's time and prints its spans, and reports them
+    in a Server-Timing header in debug mode or to admin requests
+
+    A request profiled with ?profile=1 (debug mode only) is answered with
+    its collapsed stacks instead of its page.
+    '''
+    if 'trace' not in g:
+        return response
+    elapsed = time.perf_counter() - g.started
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUEST_SECONDS.observe(elapsed, route)
+    if current_app.debug or is_admin_request():
+        spans = [f'{kind};desc="{detail}";dur={seconds * 1000:.2f}'
+            for kind, detail, seconds in g.trace]
+        response.headers['Server-Timing'] = ', '.join(spans + [f'total;dur={elapsed * 1000:.2f}'])
+    breakdown = ' '.join(f'{kind}[{detail}]={seconds * 1000:.1f}ms'
+        for kind, detail, seconds in g.trace)
+    print(f"{request.method} {request.full_path.rstrip('?')} {response.status_code} "
+        f"{elapsed * 1000:.1f}ms {breakdown}")
+    if g.profiler is not None:
+        g.profiler.stop()
+        return Response(g.profiler.collapsed(), mimetype='text/plain')
+    return response
+
+
+@bp.teardown_app_request
+def stop_profiler(exc):
+    # after_request is skipped when the view raises
+    if g.get('profiler') is not None:
+        g.profiler.stop()
+
+
+@bp.route('/metrics')
+def metrics():
+    '''request and span timing histograms and cache counters in the
+    Prometheus text format (only to admin requests)
+    '''
+    if not is_admin_request():
+        abort(403)
+    lines = REQUEST_SECONDS.render() + SPAN_SECONDS.render()
+    cache_stats = {cache.name: cache.stats() for cache in ALL_CACHES}
+    lines += ['# HELP covid_cache_lookups_total Cache lookups by outcome',
+        '# TYPE covid_cache_lookups_total counter']
+    for name, stats in cache_stats.items():
+        for outcome in ('hits', 'stale_hits', 'misses', 'coalesced'):
+            lines.append(f'covid_cache_lookups_total{{cache="{prometheus_escape(name)}",'
+                f'outcome="{outcome}"}} {stats[outcome]}')
+    lines += ['# HELP covid_cache_hit_ratio Share of lookups answered from the cache',
+        '# TYPE covid_cache_hit_ratio gauge']
+    for name, stats in cache_stats.items():
+        if stats['hit_ratio'] is not None:
+            lines.append(f'covid_cache_hit_ratio{{cache="{prometheus_escape(name)}"}} '
+                f'{stats["hit_ratio"]}')
+    lines += ['# HELP covid_rendered_html_lookups_total Rendered page and fragment cache lookups by outcome',
+        '# TYPE covid_rendered_html_lookups_total counter']
+    for name, render_cache in (('page', PAGE_CACHE), ('fragment', FRAGMENT_CACHE)):
+        lines.append(f'covid_rendered_html_lookups_total{{cache="{name}",outcome="hits"}} {render_cache.hits}')
+        lines.append(f'covid_rendered_html_lookups_total{{cache="{name}",outcome="misses"}} {render_cache.misses}')
+    return Response('\n'.join(lines) + '\n',
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def create_app(config=None):
+    '''Builds the Flask app.
+
+    Nothing slow happens here: the caches and database are opened, and
+    Plotly, BeautifulSoup and the Twitter credentials loaded, by the first
+    request that needs them.
+
+    Parameters
+    ----------
+    config: dict
+        Flask settings to apply on top of the defaults; with
+        BACKGROUND_REFRESH set, each process starts the background refresh
+        (see ensure_background_refresh) when it serves its first request
+
+    Returns
+    -------
+    Flask
+    '''
+    app = Flask(__name__)
+    if config:
+        app.config.update(config)
+    app.register_blueprint(bp)
+    if app.config.get('BACKGROUND_REFRESH'):
+        app.before_request(ensure_background_refresh)
+    return app
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    if sys.argv[1:2] == ['ingest']:
+        ingest(force='--force' in sys.argv[2:])
+    elif sys.argv[1:2] == ['ingest-covid']:
+        args = [arg for arg in sys.argv[2:] if arg != '--force']
+        ingest_covid_daily(args[0] if args else None, force='--force' in sys.argv[2:])
+    else:
+        if not os.path.exists(DB_NAME):
+            ingest()
+        create_app({'BACKGROUND_REFRESH': True}).run(debug=True)
 
 
@@ -0,0 +1,31 @@
+'''
+Checks the KFF scrapers against the trimmed pages in fixtures/kff, without
+a network connection. Run with:
+    python -m pytest test_kff_fixtures.py
+'''
+import csv
+import os
+
+import final_project_app
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures', 'kff')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def test_parse_at_risk_pop():
+    rows = final_project_app.parse_at_risk_pop(read_fixture('at_risk_pop.html'))
+    with open(os.path.join(HERE, 'at_risk_pop.csv'), newline='', encoding='utf-8-sig') as f:
+        expected = list(csv.reader(f))
+    assert len(rows) == 51
+    assert rows == expected
+
+
+def test_parse_state_url_dict():
+    state_urls = final_project_app.parse_state_url_dict(read_fixture('statedata.html'))
+    assert len(state_urls) == 56
+    assert state_urls['michigan']['state data'].endswith('?state=MI')